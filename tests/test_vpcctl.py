@@ -0,0 +1,237 @@
+"""Unit tests for vpcctl helpers that need no root or host networking.
+
+Run from the repository root: python3 -m unittest discover -s tests
+"""
+import os
+import subprocess
+import sys
+import tempfile
+import types
+import unittest
+from pathlib import Path
+from unittest import mock
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+import vpcctl  # noqa: E402
+
+
+class CommandBatcherTests(unittest.TestCase):
+    def test_unchecked_heredoc_does_not_swallow_next_command(self):
+        with tempfile.TemporaryDirectory() as d:
+            marker = os.path.join(d, "after")
+            batcher = vpcctl.CommandBatcher()
+            with batcher.active():
+                vpcctl.run_input(["sh", "-c", "cat >/dev/null; exit 1"], "payload\n", check=False)
+                vpcctl.run(["touch", marker])
+            batcher.commit(dry=False)
+            self.assertTrue(os.path.exists(marker))
+
+    def _staged_run(self, cmd):
+        batcher = vpcctl.CommandBatcher()
+        with batcher.active():
+            vpcctl.run(cmd)
+            batcher.stage_meta("t", {"name": "t", "subnets": {}})
+        self.assertTrue(vpcctl.vpc_exists("t"))
+        try:
+            batcher.commit(dry=False); ok = True
+        except subprocess.CalledProcessError:
+            ok = False
+        batcher.save_staged(ok)
+        return ok
+
+    def test_staged_meta_dropped_when_script_fails(self):
+        with tempfile.TemporaryDirectory() as d, mock.patch.multiple(vpcctl, WORKDIR=Path(d), _DB=None):
+            self.assertFalse(self._staged_run(["false"]))
+            self.assertFalse(vpcctl.vpc_exists("t"))
+
+    def test_staged_meta_written_after_script_succeeds(self):
+        with tempfile.TemporaryDirectory() as d, mock.patch.multiple(vpcctl, WORKDIR=Path(d), _DB=None):
+            self.assertTrue(self._staged_run(["true"]))
+            self.assertEqual(vpcctl.load_meta("t")["name"], "t")
+
+    def test_staged_existing_vpc_is_not_saved_by_vpc_meta(self):
+        with tempfile.TemporaryDirectory() as d, mock.patch.multiple(vpcctl, WORKDIR=Path(d), _DB=None):
+            vpcctl.save_meta("t", {"name": "t", "subnets": {}})
+            batcher = vpcctl.CommandBatcher()
+            batcher.stage_meta("t", vpcctl.load_meta("t"))
+            with batcher.active():
+                vpcctl.run(["false"])
+                with vpcctl.vpc_meta("t") as meta:
+                    meta["subnets"]["s"] = {"name": "s"}
+            with self.assertRaises(subprocess.CalledProcessError):
+                batcher.commit(dry=False)
+            batcher.save_staged(False)
+            self.assertEqual(vpcctl.load_meta("t")["subnets"], {})
+
+
+class IndexTests(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.dir.cleanup)
+        patcher = mock.patch.multiple(vpcctl, WORKDIR=Path(self.dir.name), _DB=None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        vpcctl.save_meta("a", {"name": "a", "subnets": {}})
+        vpcctl.save_meta("b", {"name": "b", "subnets": {"s": {"name": "s", "ns": "ns-b-s"}}})
+
+    def reopen(self):
+        vpcctl._DB.close()
+        vpcctl._DB = None
+        vpcctl._META_CACHE.clear()
+
+    def test_index_follows_json_files_changed_outside_vpcctl(self):
+        vpcctl._meta_path("a").unlink()
+        path = vpcctl._meta_path("b")
+        path.write_text(path.read_text().replace("ns-b-s", "ns-b-edited"))
+        vpcctl._meta_path("c").write_text('{"name": "c", "subnets": {}}')
+        self.reopen()
+        self.assertEqual(vpcctl.list_vpcs(), ["b", "c"])
+        self.assertEqual(vpcctl.recorded_namespaces(), {"ns-b-edited"})
+
+    def test_delete_of_a_missing_vpc_drops_its_index_row(self):
+        vpcctl._meta_path("a").unlink()
+        vpcctl.delete_vpc(types.SimpleNamespace(name="a", dry=False))
+        self.assertEqual(vpcctl.list_vpcs(), ["b"])
+
+
+IPTABLES_SAVE = """\
+# Generated by iptables-save v1.8.7 on Mon Nov 10 08:55:02 2025
+*nat
+:PREROUTING ACCEPT [0:0]
+:INPUT ACCEPT [0:0]
+:OUTPUT ACCEPT [0:0]
+:POSTROUTING ACCEPT [0:0]
+-A POSTROUTING -s 10.30.1.0/24 -o eth0 -m comment --comment "vpcctl:t1:nat:10.30.1.0/24" -j MASQUERADE
+COMMIT
+# Completed on Mon Nov 10 08:55:02 2025
+*filter
+:INPUT ACCEPT [0:0]
+:FORWARD DROP [0:0]
+:OUTPUT ACCEPT [0:0]
+-A FORWARD -i br-t1 -o eth0 -m comment --comment "vpcctl:t1:fwd-out" -j ACCEPT
+-A FORWARD -i eth0 -o br-t1 -m state --state RELATED,ESTABLISHED -m comment --comment "vpcctl:t1:fwd-in" -j ACCEPT
+-A FORWARD -i eth0 -o br-t2 -m conntrack --ctstate RELATED,ESTABLISHED -m comment --comment "vpcctl:t2:fwd-in" -j ACCEPT
+COMMIT
+"""
+
+
+class IptablesSnapshotTests(unittest.TestCase):
+    def setUp(self):
+        done = subprocess.CompletedProcess(["iptables-save"], 0, stdout=IPTABLES_SAVE)
+        with mock.patch.object(vpcctl.subprocess, "run", return_value=done):
+            self.batch = vpcctl.IptablesBatch(vpcctl.iptables_snapshot(("nat", "filter")))
+
+    def fwd_in(self, bridge, vpc):
+        return vpcctl.Rule("FORWARD", ("-i", "eth0", "-o", bridge, "-m", "state", "--state", "ESTABLISHED,RELATED"),
+                           "ACCEPT", f"vpcctl:{vpc}:fwd-in")
+
+    def test_installed_rules_are_skipped(self):
+        self.assertIsNone(self.batch.append(vpcctl.Rule("POSTROUTING", ("-s", "10.30.1.0/24", "-o", "eth0"),
+                                                        "MASQUERADE", "vpcctl:t1:nat:10.30.1.0/24", table="nat")))
+        self.assertIsNone(self.batch.append(vpcctl.Rule("FORWARD", ("-i", "br-t1", "-o", "eth0"), "ACCEPT",
+                                                        "vpcctl:t1:fwd-out")))
+
+    def test_reordered_state_list_matches(self):
+        self.assertIsNone(self.batch.append(self.fwd_in("br-t1", "t1")))
+
+    def test_state_match_saved_as_conntrack_matches(self):
+        self.assertIsNone(self.batch.append(self.fwd_in("br-t2", "t2")))
+
+    def test_missing_rule_is_staged(self):
+        self.assertIsNotNone(self.batch.append(self.fwd_in("br-t3", "t3")))
+        self.assertEqual(len(self.batch.lines["filter"]), 1)
+
+
+class RestorePayloadTests(unittest.TestCase):
+    def test_policy_rejects_values_that_could_break_the_restore_payload(self):
+        entries = [{"port": 80}, {"port": "1000:2000", "protocol": "UDP"}, {"protocol": "icmp"},
+                   {"port": "80\n-A INPUT -j ACCEPT"}, {"port": "22'"}, {"port": 1, "protocol": "tcp -j DROP"}]
+        self.assertEqual(vpcctl._policy_rules(entries, "ingress"),
+                         [("tcp", "80", "ACCEPT"), ("udp", "1000:2000", "ACCEPT"), ("icmp", None, "ACCEPT")])
+
+    def test_restore_join_double_quotes_and_refuses_unsafe_tokens(self):
+        self.assertEqual(vpcctl._restore_join(["--comment", "a b"]), '--comment "a b"')
+        for bad in ('a"b', "it's", "x\ny", ""):
+            with self.assertRaises(ValueError):
+                vpcctl._restore_join(["--comment", bad])
+
+
+class DeleteRuleTests(unittest.TestCase):
+    LISTING = ("-N vpc-x\n"
+               "-A vpc-x -o br-y -s 10.1.0.0/24 -d 10.2.0.0/24 -j ACCEPT\n"
+               "-A vpc-x -o br-y -s 10.1.0.0/24 -d 10.2.0.0/24 -m comment --comment vpcctl:peer:x:y -j ACCEPT\n")
+    RECORDED = ["iptables", "-A", "vpc-x", "-s", "10.1.0.0/24", "-d", "10.2.0.0/24", "-o", "br-y",
+                "-m", "comment", "--comment", "vpcctl:peer:x:y", "-j", "ACCEPT"]
+
+    def _delete(self, recorded):
+        calls = []
+
+        def fake_run(cmd, **kw):
+            calls.append(cmd)
+            if len(calls) == 1:  # the exact -D misses (argument order differs)
+                raise subprocess.CalledProcessError(1, cmd)
+
+        listing = subprocess.CompletedProcess([], 0, stdout=self.LISTING)
+        with mock.patch.object(vpcctl, "run", side_effect=fake_run), \
+                mock.patch.object(vpcctl.subprocess, "run", return_value=listing):
+            return vpcctl._delete_rule(recorded, dry=False), calls
+
+    def test_fallback_deletes_the_commented_rule_by_spec(self):
+        ok, calls = self._delete(self.RECORDED)
+        self.assertTrue(ok)
+        self.assertEqual(calls[-1], ["iptables", "-t", "filter", "-D", "vpc-x", "-o", "br-y", "-s", "10.1.0.0/24",
+                                     "-d", "10.2.0.0/24", "-m", "comment", "--comment", "vpcctl:peer:x:y",
+                                     "-j", "ACCEPT"])
+
+    def test_fallback_needs_a_comment_marker(self):
+        uncommented = self.RECORDED[:9] + self.RECORDED[13:]
+        ok, calls = self._delete(uncommented)
+        self.assertFalse(ok)
+        self.assertEqual(len(calls), 1)
+
+    def test_failed_restore_requeues_each_rule_once(self):
+        absent = self.RECORDED[:12] + ["vpcctl:peer:x:z"] + self.RECORDED[13:]
+        listing = subprocess.CompletedProcess([], 0, stdout=self.LISTING)
+        with mock.patch.object(vpcctl.subprocess, "run", return_value=listing), \
+                mock.patch.object(vpcctl, "iptables_batch", side_effect=subprocess.CalledProcessError(1, "x")), \
+                mock.patch.object(vpcctl, "_delete_rule") as slow:
+            vpcctl._delete_rules([self.RECORDED, absent], dry=False)
+        self.assertCountEqual([c.args[0] for c in slow.call_args_list], [absent, self.RECORDED])
+
+
+class NamingTests(unittest.TestCase):
+    def test_vpc_chains_do_not_collide_on_a_shared_prefix(self):
+        a, b = vpcctl._vpc_chain("production-a"), vpcctl._vpc_chain("production-b")
+        self.assertNotEqual(a, b)
+        self.assertLessEqual(max(len(a), len(b)), 28)
+
+    def test_chain_owner_reads_the_intra_comment(self):
+        listing = subprocess.CompletedProcess([], 0, stdout=(
+            "-N vpc-x\n-A vpc-x -s 10.0.0.0/16 -d 10.0.0.0/16 -m comment --comment vpcctl:other:intra -j ACCEPT\n"))
+        with mock.patch.object(vpcctl.subprocess, "run", return_value=listing):
+            self.assertEqual(vpcctl._chain_owner("vpc-x"), "other")
+        with mock.patch.object(vpcctl.subprocess, "run", return_value=subprocess.CompletedProcess([], 1, stdout="")):
+            self.assertIsNone(vpcctl._chain_owner("vpc-x"))
+
+    def test_nft_tables_do_not_collide_on_sanitized_names(self):
+        self.assertNotEqual(vpcctl._nft_table("a-b"), vpcctl._nft_table("a_b"))
+
+    def test_peer_ipsets_are_per_pair_and_within_the_ipset_limit(self):
+        self.assertNotEqual(vpcctl._peer_ipset("a-b", "c"), vpcctl._peer_ipset("a", "b-c"))
+        self.assertEqual(vpcctl._peer_ipset("a", "b"), vpcctl._peer_ipset("b", "a"))
+        long = [vpcctl._peer_ipset("production-alpha", f"production-{x}") for x in ("beta", "gamma")]
+        self.assertNotEqual(*long)
+        self.assertLessEqual(max(map(len, long)), 31)
+
+
+class ParserSniffTests(unittest.TestCase):
+    def test_help_in_a_short_option_cluster_builds_every_subparser(self):
+        for argv in (["-vh", "create"], ["--he", "create"], ["-h"]):
+            self.assertIsNone(vpcctl._sniff_subcommand(argv))
+        self.assertEqual(vpcctl._sniff_subcommand(["-v", "create", "x"]), "create")
+        self.assertTrue(vpcctl._wants_help(["create", "-vh"]))
+        self.assertFalse(vpcctl._wants_help(["-v", "create", "x"]))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,781 +1,1760 @@
-#!/usr/bin/env python3
-"""vpcctl - single-host VPC 
-
-This script is my practical toolkit for creating reproducible, isolated VPC-like
-environments on a single Linux host. It uses network namespaces, veth pairs and
-bridges plus iptables for access control. The design goals were:
-
-- Be small and explicit: each operation prints the commands it runs and stores
-    a minimal JSON metadata file in `.vpcctl_data/` so the state is reproducible.
-- Keep operations idempotent where reasonable (creation skips existing things,
-    iptables rules are checked before insertion).
-- Make cleanup deterministic: metadata records host-level iptables commands so
-    delete can try to remove exactly what was added.
-
-File organization (logical parts)
-1) Small helpers and filesystem/arg parsing utilities
-2) iptables helpers (existence checks, comment injection, add/delete wrappers)
-3) Core VPC lifecycle: create_vpc, add_subnet, delete_vpc, cleanup_all
-4) Features: enable_nat, create_peer, apply_policy
-5) App lifecycle: deploy_app, stop_app, test_connectivity
-6) Verification, demo orchestration and CLI wiring
-
-Important safety notes
-- This script must be run as root. It modifies host networking (interfaces, rules)
-    and can break connectivity if misused. Use `--dry-run` to preview commands.
-- iptables comment matching is relied upon for robust deletion; if you manually
-    edit rules, delete may not remove them automatically.
-"""
-
-from __future__ import annotations
-
-import argparse, json, os, subprocess, sys, ipaddress, shutil, shlex
-from pathlib import Path
-from typing import List, Dict, Any, Callable, Optional
-
-WORKDIR = Path.cwd() / ".vpcctl_data"
-WORKDIR.mkdir(parents=True, exist_ok=True)
-
-# ------------------------------------------------------------------
-# Generic utilities
-# ------------------------------------------------------------------
-
-def run(cmd: List[str], *, check: bool = True, capture_output: bool = False, dry: bool = False):
-    print(">>>", " ".join(cmd))
-    if dry:
-        return None
-    return subprocess.run(cmd, check=check, capture_output=capture_output)
-
-
-def require_root():
-    if os.geteuid() != 0:
-        print("vpcctl: must be run as root (sudo)")
-        sys.exit(2)
-
-
-def safe_ifname(parts, prefix="", suffix="", maxlen: int = 15):
-    """Return safe interface name: join parts, sanitize, truncate."""
-    import re
-    if isinstance(parts, (list, tuple)):
-        core = "-".join(str(p) for p in parts if p is not None)
-    else:
-        core = str(parts)
-    core = re.sub(r"[^A-Za-z0-9-]", "-", core)
-    core = re.sub(r"-{2,}", "-", core)
-    avail = maxlen - len(prefix) - len(suffix)
-    if avail <= 0:
-        return (prefix + suffix)[:maxlen]
-    if len(core) > avail:
-        core = core[:avail]
-    return f"{prefix}{core}{suffix}"
-
-
-# ------------------------------------------------------------------
-# Metadata helpers
-# ------------------------------------------------------------------
-
-def _meta_path(name: str) -> Path:
-    return WORKDIR / f"vpc_{name}.json"
-
-
-def vpc_exists(name: str) -> bool:
-    return _meta_path(name).exists()
-
-
-def load_meta(name: str) -> Dict[str, Any]:
-    p = _meta_path(name)
-    if not p.exists():
-        raise FileNotFoundError(p)
-    return json.load(open(p))
-
-
-def save_meta(name: str, meta: Dict[str, Any]):
-    with open(_meta_path(name), "w") as f:
-        json.dump(meta, f, indent=2)
-
-
-def list_vpcs() -> List[str]:
-    return [p.stem.replace("vpc_", "") for p in WORKDIR.glob("vpc_*.json")]
-
-
-# ------------------------------------------------------------------
-# iptables helpers
-# ------------------------------------------------------------------
-
-def _iptables_rule_exists(cmd: List[str]) -> bool:
-    test = cmd.copy()
-    for i, t in enumerate(test):
-        if t in ("-A", "-I"):
-            test[i] = "-C"; break
-    try:
-        r = subprocess.run(test, check=False, capture_output=True)
-        return r.returncode == 0
-    except Exception:
-        return False
-
-
-def _insert_comment(cmd: List[str], comment: str) -> List[str]:
-    c = cmd.copy()
-    try:
-        j = c.index("-j")
-    except ValueError:
-        j = len(c)
-    c[j:j] = ["-m", "comment", "--comment", comment]
-    return c
-
-
-def _add_rule(cmd: List[str], *, comment: Optional[str], dry: bool) -> bool:
-    use = _insert_comment(cmd, comment) if comment else cmd.copy()
-    if _iptables_rule_exists(use):
-        print("iptables: rule exists, skipping:", " ".join(use))
-        return False
-    run(use, dry=dry)
-    return True
-
-
-def _delete_rule(cmd: List[str], *, dry: bool) -> bool:
-    if dry:
-        print("(dry) would delete:", cmd)
-        return True
-
-    def try_cd(base: List[str]) -> bool:
-        chk = base.copy()
-        for i, t in enumerate(chk):
-            if t in ("-A", "-I"):
-                chk[i] = "-C"; break
-        try:
-            run(chk, check=True)
-            d = base.copy()
-            for i, t in enumerate(d):
-                if t in ("-A", "-I"):
-                    d[i] = "-D"; break
-            run(d, check=True)
-            return True
-        except Exception:
-            return False
-
-    try:
-        if try_cd(cmd):
-            return True
-    except Exception:
-        pass
-
-    table = 'filter'
-    if '-t' in cmd:
-        try:
-            table = cmd[cmd.index('-t') + 1]
-        except Exception:
-            table = 'filter'
-    try:
-        out = subprocess.run(['iptables', '-t', table, '-S'], capture_output=True, text=True)
-        rules_text = out.stdout or ''
-    except Exception:
-        rules_text = ''
-
-    key = []
-    skip = False
-    for i, t in enumerate(cmd):
-        if skip: skip = False; continue
-        if t == 'iptables': continue
-        if t == '-t': skip = True; continue
-        if t in ('-A','-I','-D'): continue
-        if t == '-m' and i+1 < len(cmd) and cmd[i+1]=='comment': skip = True; continue
-        if t == '--comment': skip = True; continue
-        key.append(t)
-
-    for line in rules_text.splitlines():
-        if not line.strip():
-            continue
-        if all(k in line for k in key):
-            parts = shlex.split(line)
-            if parts and parts[0] == '-A': parts[0] = '-D'
-            full = ['iptables', '-t', table] + parts
-            try:
-                run(full, check=True); return True
-            except Exception:
-                try:
-                    run(['iptables'] + parts, check=True); return True
-                except Exception:
-                    continue
-
-    # last resort: strip comments
-    stripped = []
-    i = 0
-    while i < len(cmd):
-        tok = cmd[i]
-        if tok == '-m' and i+1 < len(cmd) and cmd[i+1]=='comment': i += 4; continue
-        if tok == '--comment': i += 2; continue
-        stripped.append(tok); i += 1
-    for i, t in enumerate(stripped):
-        if t in ('-A','-I'): stripped[i] = '-D'; break
-    try:
-        run(stripped, check=True); return True
-    except Exception:
-        return False
-
-
-# ------------------------------------------------------------------
-# Small internal helpers
-# ------------------------------------------------------------------
-
-def _parse_network(cidr: str):
-    try:
-        return ipaddress.ip_network(cidr)
-    except Exception as e:
-        print(f"Invalid CIDR: {cidr}: {e}"); sys.exit(1)
-
-
-def _find_subnet(meta: Dict[str, Any], *, name: Optional[str] = None, cidr: Optional[str] = None):
-    for s in meta.get("subnets", []):
-        if name and s.get("name") == name: return s
-        if cidr and s.get("cidr") == cidr: return s
-    return None
-
-
-def _record_rule(meta: Dict[str, Any], cmd: List[str], comment: str):
-    meta.setdefault("host_iptables", []).append(_insert_comment(cmd, comment))
-
-
-# ------------------------------------------------------------------
-# Core lifecycle
-# ------------------------------------------------------------------
-
-def create_vpc(args):
-    require_root()
-    # Ensure default isolation: block all forwarding by default
-    run(["iptables", "-P", "FORWARD", "DROP"], dry=args.dry)
-    name = args.name
-    cidr = getattr(args, 'cidr_flag', None) or getattr(args, 'cidr', None)
-    dry = args.dry
-    _ = _parse_network(cidr)
-    if vpc_exists(name):
-        print(f"VPC '{name}' already exists (idempotent).")
-        return
-    bridge = safe_ifname([name], prefix="br-", maxlen=15)
-    run(["ip", "link", "add", "name", bridge, "type", "bridge"], dry=dry)
-    run(["ip", "link", "set", bridge, "up"], dry=dry)
-    run(["sysctl", "-w", "net.ipv4.ip_forward=1"], dry=dry)
-    chain = f"vpc-{safe_ifname([name], maxlen=10)}"
-    run(["iptables", "-N", chain], check=False, dry=dry)
-    host_rules = []
-    jump = ["iptables", "-I", "FORWARD", "-i", bridge, "-j", chain]
-    if _add_rule(jump, comment=f"vpcctl:{name}:jump", dry=dry):
-        host_rules.append(_insert_comment(jump, f"vpcctl:{name}:jump"))
-    intra = ["iptables", "-A", chain, "-s", cidr, "-d", cidr, "-j", "ACCEPT"]
-    if _add_rule(intra, comment=f"vpcctl:{name}:intra", dry=dry):
-        host_rules.append(_insert_comment(intra, f"vpcctl:{name}:intra"))
-    meta = {"name": name, "cidr": cidr, "bridge": bridge, "subnets": [],
-            "host_iptables": host_rules, "chain": chain, "apps": [], "peers": []}
-    # Do not persist state in dry-run; keep dry-run side-effect free
-    if not dry:
-        save_meta(name, meta)
-    else:
-        print("(dry-run) metadata not written for VPC create")
-    print(f"Created VPC '{name}' with bridge '{bridge}' and CIDR {cidr}")
-
-
-def add_subnet(args):
-    require_root()
-    vpc = args.vpc; sub_name = args.name
-    cidr = getattr(args, 'cidr_flag', None) or getattr(args, 'cidr', None)
-    dry = args.dry
-    if not vpc_exists(vpc):
-        print(f"VPC '{vpc}' not found. Create it first."); sys.exit(1)
-    net = _parse_network(cidr)
-    meta = load_meta(vpc); bridge = meta["bridge"]
-    # Compute namespace name early for repair checks
-    ns = f"ns-{vpc}-{sub_name}"
-    # If metadata says the subnet exists, verify the namespace truly exists; if not, repair
-    existing = next((s for s in meta.get("subnets", []) if s.get("name") == sub_name), None)
-    if existing:
-        try:
-            out = subprocess.run(["ip", "netns", "list"], capture_output=True, text=True)
-            ns_list = out.stdout or ""
-        except Exception:
-            ns_list = ""
-        if ns in ns_list:
-            print(f"Subnet '{sub_name}' already exists in VPC '{vpc}' (idempotent).")
-            return
-        else:
-            print(f"Subnet '{sub_name}' recorded but namespace missing; repairing…")
-    v_host_base = f"v-{vpc}-{sub_name}".replace('/', '-')
-    v_peer_base = f"vbr-{vpc}-{sub_name}".replace('/', '-')
-    run(["ip", "netns", "add", ns], dry=dry)
-    # Collision avoidance: manual suffix insertion preserving uniqueness within 15 char Linux ifname limit.
-    # Earlier approach using safe_ifname truncated away numeric suffixes (e.g. both 'public' and 'private' -> 'vbr-prod-test-p').
-    # Here we truncate base keeping room for suffix explicitly.
-    if not dry:
-        existing_links = subprocess.run(["ip", "link", "show"], capture_output=True, text=True).stdout.splitlines()
-        existing_names = {ln.split()[1].rstrip(':') for ln in existing_links if ln}
-    else:
-        existing_names = set()
-    def mk_with_suffix(base: str, suffix: str) -> str:
-        limit = 15
-        if len(base) + len(suffix) <= limit:
-            return base + suffix
-        return base[:limit - len(suffix)] + suffix
-    for attempt in range(10):
-        suffix = '' if attempt == 0 else str(attempt)
-        v_host = mk_with_suffix(v_host_base, suffix)
-        v_peer = mk_with_suffix(v_peer_base, suffix)
-        try:
-            if v_host in existing_names or v_peer in existing_names:
-                raise subprocess.CalledProcessError(returncode=2, cmd=["ip","link","add",v_host])
-            run(["ip", "link", "add", v_host, "type", "veth", "peer", "name", v_peer], dry=dry)
-            break
-        except subprocess.CalledProcessError:
-            if attempt == 9:
-                raise
-            continue
-    run(["ip", "link", "set", v_peer, "master", bridge], dry=dry)
-    run(["ip", "link", "set", v_peer, "up"], dry=dry)
-    run(["ip", "link", "set", v_host, "netns", ns], dry=dry)
-    hosts = list(net.hosts())
-    if len(hosts) < 2:
-        print(f"CIDR {cidr} too small for gateway+host"); sys.exit(1)
-    prefix = net.prefixlen
-    if getattr(args, 'gw', None):
-        bridge_gw = args.gw
-        host_ip = next((str(h) for h in hosts if str(h) != bridge_gw), None)
-        if not host_ip:
-            print("Could not allocate host IP"); sys.exit(1)
-    else:
-        bridge_gw, host_ip = str(hosts[0]), str(hosts[1])
-    run(["ip", "addr", "add", f"{bridge_gw}/{prefix}", "dev", bridge], check=False, dry=dry)
-    run(["ip", "netns", "exec", ns, "ip", "addr", "add", f"{host_ip}/{prefix}", "dev", v_host], dry=dry)
-    run(["ip", "netns", "exec", ns, "ip", "link", "set", v_host, "up"], dry=dry)
-    run(["ip", "netns", "exec", ns, "ip", "link", "set", "lo", "up"], dry=dry)
-    run(["ip", "netns", "exec", ns, "ip", "route", "add", "default", "via", bridge_gw], dry=dry)
-    # Persist only when not dry; update existing record if repairing
-    if not dry:
-        if existing:
-            existing.update({"cidr": cidr, "ns": ns, "gw": bridge_gw, "host_ip": host_ip, "veth": v_host})
-        else:
-            meta.setdefault("subnets", []).append({"name": sub_name, "cidr": cidr, "ns": ns, "gw": bridge_gw,
-                                                    "host_ip": host_ip, "veth": v_host})
-        save_meta(vpc, meta)
-    else:
-        print("(dry-run) metadata not written for add-subnet")
-    # Policy merge (preserves original behavior, just factored)
-    try:
-        _merge_and_apply_policy(vpc, sub_name, cidr, dry)
-    except Exception as e:
-        print(f"Warning: policy merge/apply failed: {e}")
-    print(f"Created subnet '{sub_name}' ({cidr}) in VPC '{vpc}' ns='{ns}' gw={bridge_gw}")
-
-
-def _merge_and_apply_policy(vpc: str, sub_name: str, cidr: str, dry: bool):
-    default_path = WORKDIR / f"policy_{vpc}_default.json"
-    subnet_path = WORKDIR / f"policy_{vpc}_{sub_name}_{cidr.replace('/', '_')}.json"
-    if not subnet_path.exists():
-        policy = {"subnet": cidr, "ingress": [
-            {"port": 80, "protocol": "tcp", "action": "allow"},
-            {"port": 443, "protocol": "tcp", "action": "allow"},
-            {"port": 22, "protocol": "tcp", "action": "deny"}], "egress": []}
-        json.dump(policy, open(subnet_path, "w"), indent=2)
-    merged: List[Dict[str, Any]] = []
-    if default_path.exists():
-        try:
-            dp = json.load(open(default_path))
-            if isinstance(dp, dict): dp = [dp]
-            for e in dp:
-                e = dict(e)
-                if not e.get("subnet") or e.get("subnet") in ("*", cidr):
-                    e["subnet"] = cidr; merged.append(e)
-        except Exception as e:
-            print(f"Warning: read default policy failed: {e}")
-    try:
-        sp = json.load(open(subnet_path))
-        if isinstance(sp, dict): sp = [sp]
-        for e in sp:
-            ee = dict(e); ee["subnet"] = cidr; merged.append(ee)
-    except Exception as e:
-        print(f"Warning: read subnet policy failed: {e}")
-    merged_path = WORKDIR / f"policy_{vpc}_{sub_name}_{cidr.replace('/', '_')}_merged.json"
-    with open(merged_path, "w") as mf:
-        json.dump(merged[0] if len(merged) == 1 else merged, mf, indent=2)
-    if dry:
-        print(f"Would apply merged policy (dry-run): {merged_path}")
-        return
-    from types import SimpleNamespace
-    apply_policy(SimpleNamespace(vpc=vpc, policy_file=str(merged_path), dry=dry))
-    print(f"Applied merged policy -> {merged_path}")
-
-
-def list_command(args):
-    vpcs = list_vpcs()
-    if not vpcs:
-        print("No VPCs found"); return
-    for v in vpcs: print(v)
-
-
-def inspect_command(args):
-    name = args.name
-    try:
-        meta = load_meta(name)
-    except FileNotFoundError:
-        print(f"VPC '{name}' not found"); return
-    print(json.dumps(meta, indent=2))
-
-
-def delete_vpc(args):
-    require_root()
-    name = args.name; dry = args.dry
-    if not vpc_exists(name):
-        print(f"VPC '{name}' not found; nothing to delete."); return
-    meta = load_meta(name)
-    for app in meta.get("apps", []):
-        pid = app.get("pid")
-        if pid: run(["kill", "-TERM", str(pid)], check=False, dry=dry)
-    for s in meta.get("subnets", []):
-        ns = s.get("ns")
-        run(["ip", "netns", "exec", ns, "iptables", "-F"], check=False, dry=dry)
-        run(["ip", "netns", "exec", ns, "iptables", "-t", "nat", "-F"], check=False, dry=dry)
-        run(["ip", "netns", "del", ns], check=False, dry=dry)
-    bridge = meta.get("bridge")
-    run(["ip", "link", "set", bridge, "down"], check=False, dry=dry)
-    run(["ip", "link", "del", bridge, "type", "bridge"], check=False, dry=dry)
-    if meta.get("nat"):
-        for r in list(meta.get("host_iptables", [])):
-            try: _delete_rule(r, dry=dry)
-            except Exception: pass
-        meta["host_iptables"] = []; save_meta(name, meta)
-    chain = meta.get("chain")
-    if chain:
-        run(["iptables", "-D", "FORWARD", "-i", bridge, "-j", chain], check=False, dry=dry)
-        run(["iptables", "-F", chain], check=False, dry=dry)
-        run(["iptables", "-X", chain], check=False, dry=dry)
-    if not dry:
-        try: _meta_path(name).unlink()
-        except Exception: pass
-    print(f"Deleted VPC '{name}' and cleaned up resources")
-
-
-def cleanup_all(args):
-    require_root(); dry = args.dry
-    vpcs = list_vpcs()
-    if not vpcs:
-        print("No VPCs to clean up"); return
-    for v in vpcs:
-        a = argparse.Namespace(name=v, dry=dry)
-        delete_vpc(a)
-    print("All recorded VPCs cleaned up")
-
-
-def verify(args):
-    out = subprocess.run(["ip", "netns", "list"], capture_output=True, text=True)
-    ns_lines = out.stdout.strip().splitlines() if out.stdout else []
-    vpc_ns = [l.split()[0] for l in ns_lines if l.startswith("ns-")]
-    out2 = subprocess.run(["ip", "link", "show", "type", "bridge"], capture_output=True, text=True)
-    br_lines = out2.stdout.strip().splitlines() if out2.stdout else []
-    bridges = [ln.split()[1].rstrip(':') for ln in br_lines if len(ln.split()) >= 2 and ln.split()[1].startswith("br-")]
-    print("vpcctl-looking namespaces:", vpc_ns)
-    print("vpcctl-looking bridges:", bridges)
-    recorded = list_vpcs()
-    print("Recorded VPCs:", recorded)
-    orphans = []
-    for ns in vpc_ns:
-        found = False
-        for v in recorded:
-            meta = load_meta(v)
-            if any(s.get("ns") == ns for s in meta.get("subnets", [])):
-                found = True; break
-        if not found: orphans.append(ns)
-    print("Orphan namespaces (no metadata):", orphans if orphans else "None")
-
-
-def create_peer(args):
-    require_root()
-    vpc1, vpc2, dry = args.vpc1, args.vpc2, args.dry
-    if vpc1 == vpc2:
-        print("Cannot peer a VPC to itself"); sys.exit(1)
-    if not (vpc_exists(vpc1) and vpc_exists(vpc2)):
-        print("Both VPCs must exist to create a peer"); sys.exit(1)
-    m1, m2 = load_meta(vpc1), load_meta(vpc2)
-    b1, b2 = m1["bridge"], m2["bridge"]
-    allow = [c.strip() for c in args.allow_cidrs.split(',')] if args.allow_cidrs else [m1.get("cidr"), m2.get("cidr")]
-    veth_a = safe_ifname([vpc1, vpc2], prefix="pv-", suffix="a", maxlen=15)
-    veth_b = safe_ifname([vpc1, vpc2], prefix="pv-", suffix="b", maxlen=15)
-    links = subprocess.run(["ip", "link", "show"], capture_output=True, text=True).stdout
-    if veth_a not in links and veth_b not in links:
-        run(["ip", "link", "add", veth_a, "type", "veth", "peer", "name", veth_b], dry=dry)
-        run(["ip", "link", "set", veth_a, "master", b1], dry=dry)
-        run(["ip", "link", "set", veth_b, "master", b2], dry=dry)
-        run(["ip", "link", "set", veth_a, "up"], dry=dry)
-        run(["ip", "link", "set", veth_b, "up"], dry=dry)
-    c1, c2 = m1.get("chain"), m2.get("chain")
-    if not (c1 and c2):
-        print("Per-VPC chains not found; ensure VPCs were created by vpcctl")
-    for src in allow:
-        for dst in allow:
-            r1 = ["iptables", "-A", c1, "-o", b2, "-s", src, "-d", dst, "-j", "ACCEPT"]
-            r2 = ["iptables", "-A", c2, "-o", b1, "-s", src, "-d", dst, "-j", "ACCEPT"]
-            if _add_rule(r1, comment=f"vpcctl:peer:{vpc1}:{vpc2}", dry=dry): _record_rule(m1, r1, f"vpcctl:peer:{vpc1}:{vpc2}")
-            if _add_rule(r2, comment=f"vpcctl:peer:{vpc1}:{vpc2}", dry=dry): _record_rule(m2, r2, f"vpcctl:peer:{vpc1}:{vpc2}")
-    d1 = ["iptables", "-A", c1, "-o", b2, "-j", "DROP"]
-    d2 = ["iptables", "-A", c2, "-o", b1, "-j", "DROP"]
-    if _add_rule(d1, comment=f"vpcctl:peer-drop:{vpc1}:{vpc2}", dry=dry): _record_rule(m1, d1, f"vpcctl:peer-drop:{vpc1}:{vpc2}")
-    if _add_rule(d2, comment=f"vpcctl:peer-drop:{vpc1}:{vpc2}", dry=dry): _record_rule(m2, d2, f"vpcctl:peer-drop:{vpc1}:{vpc2}")
-    pr = {"peer_vpc": vpc2, "veth_a": veth_a, "veth_b": veth_b, "allowed": allow}
-    if not any(p.get("peer_vpc") == vpc2 for p in m1.get("peers", [])):
-        m1.setdefault("peers", []).append(pr); save_meta(vpc1, m1)
-    pr_rev = {"peer_vpc": vpc1, "veth_a": veth_b, "veth_b": veth_a, "allowed": allow}
-    if not any(p.get("peer_vpc") == vpc1 for p in m2.get("peers", [])):
-        m2.setdefault("peers", []).append(pr_rev); save_meta(vpc2, m2)
-    print(f"Peered '{vpc1}' <-> '{vpc2}' via {veth_a}/{veth_b}. Allowed: {allow}")
-
-
-def enable_nat(args):
-    require_root()
-    name = args.name
-    intf = getattr(args, 'iface_flag', None) or getattr(args, 'iface', None)
-    target_subnet = getattr(args, 'subnet', None)
-    all_subnets = getattr(args, 'all_subnets', False)
-    dry = args.dry
-    if not vpc_exists(name):
-        print(f"VPC '{name}' not found"); sys.exit(1)
-    meta = load_meta(name)
-    bridge = meta.get("bridge")
-    run(["sysctl", "-w", "net.ipv4.ip_forward=1"], dry=dry)
-    cidrs: List[str] = []
-    if all_subnets:
-        cidrs = [s.get("cidr") for s in meta.get("subnets", []) if s.get("cidr")]
-        if not cidrs and meta.get("cidr"): cidrs = [meta.get("cidr")]
-    elif target_subnet:
-        for s in meta.get("subnets", []):
-            if s.get("name") == target_subnet and s.get("cidr"): cidrs.append(s.get("cidr")); break
-    else:
-        for s in meta.get("subnets", []):
-            if str(s.get("name", "")).lower() == "public" and s.get("cidr"): cidrs.append(s.get("cidr"))
-    if not cidrs:
-        print("No subnets matched for NAT (try --subnet or --all-subnets). Leaving NAT unchanged.")
-    else:
-        for c in cidrs:
-            nat_cmd = ["iptables", "-t", "nat", "-A", "POSTROUTING", "-s", c, "-o", intf, "-j", "MASQUERADE"]
-            if _add_rule(nat_cmd, comment=f"vpcctl:{name}:nat:{c}", dry=dry): _record_rule(meta, nat_cmd, f"vpcctl:{name}:nat:{c}")
-        out_rule = ["iptables", "-A", "FORWARD", "-i", bridge, "-o", intf, "-j", "ACCEPT"]
-        if _add_rule(out_rule, comment=f"vpcctl:{name}:fwd-out", dry=dry): _record_rule(meta, out_rule, f"vpcctl:{name}:fwd-out")
-        in_rule = ["iptables", "-A", "FORWARD", "-i", intf, "-o", bridge, "-m", "state", "--state", "ESTABLISHED,RELATED", "-j", "ACCEPT"]
-        if _add_rule(in_rule, comment=f"vpcctl:{name}:fwd-in", dry=dry): _record_rule(meta, in_rule, f"vpcctl:{name}:fwd-in")
-    meta["nat"] = {"interface": intf, "cidrs": cidrs}
-    save_meta(name, meta)
-    print((f"Enabled NAT for '{name}' via '{intf}' -> {cidrs}" if cidrs else f"No CIDRs NATed for '{name}'"))
-
-
-def apply_policy(args):
-    require_root(); vpc = args.vpc; pf = args.policy_file; dry = args.dry
-    if not vpc_exists(vpc): print(f"VPC '{vpc}' not found"); sys.exit(1)
-    try:
-        pol = json.load(open(pf))
-    except Exception as e:
-        print(f"Failed to read policy file: {e}"); sys.exit(1)
-    if isinstance(pol, dict): pol = [pol]
-    meta = load_meta(vpc)
-    for p in pol:
-        scidr = p.get("subnet")
-        if not scidr:
-            print("Policy missing 'subnet'; skipping"); continue
-        target = _find_subnet(meta, cidr=scidr)
-        if not target:
-            print(f"No subnet in VPC '{vpc}' matches {scidr}; skipping"); continue
-        ns = target.get("ns")
-        run(["ip", "netns", "exec", ns, "iptables", "-F"], dry=dry)
-        run(["ip", "netns", "exec", ns, "iptables", "-A", "INPUT", "-i", "lo", "-j", "ACCEPT"], dry=dry)
-        run(["ip", "netns", "exec", ns, "iptables", "-A", "INPUT", "-m", "state", "--state", "ESTABLISHED,RELATED", "-j", "ACCEPT"], dry=dry)
-        for r in p.get("ingress", []):
-            proto = r.get("protocol", "tcp"); port = r.get("port"); act = r.get("action", "allow").lower()
-            if port is None: print("Skipping ingress without port"); continue
-            target_rule = "ACCEPT" if act == "allow" else "DROP"
-            run(["ip","netns","exec",ns,"iptables","-A","INPUT","-p",proto,"--dport",str(port),"-j",target_rule], dry=dry)
-        for r in p.get("egress", []):
-            proto = r.get("protocol", "tcp"); port = r.get("port"); act = r.get("action", "allow").lower()
-            if port is None: print("Skipping egress without port"); continue
-            target_rule = "ACCEPT" if act == "allow" else "DROP"
-            run(["ip","netns","exec",ns,"iptables","-A","OUTPUT","-p",proto,"--dport",str(port),"-j",target_rule], dry=dry)
-        print(f"Applied policy to {scidr} (ns {ns})")
-
-
-def deploy_app(args):
-    require_root(); vpc = args.vpc; subnet = args.subnet; port = getattr(args,'port_flag', None) or getattr(args,'port', None)
-    dry = args.dry
-    if not vpc_exists(vpc): print(f"VPC '{vpc}' not found"); sys.exit(1)
-    meta = load_meta(vpc)
-    target = _find_subnet(meta, name=subnet)
-    if not target: print(f"Subnet '{subnet}' not found in VPC '{vpc}'"); sys.exit(1)
-    ns = target.get("ns")
-    cmd = ["ip","netns","exec",ns,"python3","-m","http.server",str(port)]
-    print(f"Starting HTTP server in {ns} port {port}")
-    if dry: print("DRY:", " ".join(cmd)); return
-    try:
-        shell_cmd = f"ip netns exec {ns} nohup python3 -m http.server {port} >/tmp/vpcctl-{ns}-http.log 2>&1 & echo $!"
-        out = subprocess.check_output(shell_cmd, shell=True, text=True).strip()
-        pid = int(out.splitlines()[-1]) if out else None
-        print(f"HTTP server started ns={ns} pid={pid} log=/tmp/vpcctl-{ns}-http.log")
-        meta.setdefault("apps", []).append({"ns": ns, "port": port, "pid": pid, "cmd": cmd})
-        save_meta(vpc, meta)
-    except Exception as e:
-        print(f"Failed to start HTTP server: {e}")
-
-
-def stop_app(args):
-    require_root(); vpc = args.vpc; ns = args.ns; pid = args.pid; dry = args.dry
-    if not vpc_exists(vpc): print(f"VPC '{vpc}' not found"); return
-    meta = load_meta(vpc)
-    removed = []
-    for app in list(meta.get("apps", [])):
-        if ns and app.get("ns") != ns: continue
-        if pid and str(app.get("pid")) != str(pid): continue
-        apid = app.get("pid")
-        if apid: run(["kill","-TERM",str(apid)], check=False, dry=dry)
-        meta.get("apps", []).remove(app); removed.append(app)
-    save_meta(vpc, meta)
-    print(f"Stopped apps: {removed}" if removed else "No matching apps found to stop")
-
-
-def test_connectivity(args):
-    target, port, from_ns, dry = args.target, args.port, args.from_ns, args.dry
-    cmd = ["ip","netns","exec",from_ns,"curl","-sS",f"http://{target}:{port}"] if from_ns else ["curl","-sS",f"http://{target}:{port}"]
-    print("Testing connectivity:", " ".join(cmd))
-    if dry: return
-    try:
-        r = subprocess.run(cmd, check=True, capture_output=True, timeout=5)
-        out = r.stdout.decode(errors='ignore')
-        print("Connectivity OK — response snapshot:\n", out[:200])
-    except subprocess.CalledProcessError:
-        print("Connectivity test failed (non-zero exit)")
-    except Exception as e:
-        print(f"Connectivity test error: {e}")
-
-
-# ------------------------------------------------------------------
-# Demo orchestration (kept same semantics)
-# ------------------------------------------------------------------
-
-def run_demo(args):
-    execute = args.execute; iface = args.iface; dry = not execute
-    a = {"name": "demo-a", "cidr": "10.10.0.0/16", "public": "10.10.1.0/24", "private": "10.10.2.0/24"}
-    b = {"name": "demo-b", "cidr": "10.20.0.0/16", "public": "10.20.1.0/24"}
-    steps = [
-        ("create", [a['name'], a['cidr']]),
-        ("add-subnet", [a['name'], "public", a['public']]),
-        ("add-subnet", [a['name'], "private", a['private']]),
-        ("create", [b['name'], b['cidr']]),
-        ("add-subnet", [b['name'], "public", b['public']]),
-        ("deploy-app", [a['name'], "public", "8080"]),
-    ]
-    if execute:
-        if not iface:
-            print("--internet-iface required with --execute"); return
-        steps.append(("enable-nat", [a['name'], iface]))
-    steps.append(("peer", [a['name'], b['name'], "--allow-cidrs", f"{a['public']},{b['public']}"]))
-    for cmd_name, argv in steps:
-        print(f"\n=== STEP: {cmd_name} {' '.join(argv)} ===")
-        ns = argparse.Namespace(dry=dry)
-        try:
-            if cmd_name == "create": ns.name, ns.cidr = argv; create_vpc(ns)
-            elif cmd_name == "add-subnet": ns.vpc, ns.name, ns.cidr = argv; add_subnet(ns)
-            elif cmd_name == "deploy-app": ns.vpc, ns.subnet, ns.port = argv; deploy_app(ns)
-            elif cmd_name == "enable-nat": ns.name, ns.iface = argv; enable_nat(ns)
-            elif cmd_name == "peer": ns.vpc1, ns.vpc2 = argv[0], argv[1]; ns.allow_cidrs = argv[3]; create_peer(ns)
-        except Exception as e:
-            print(f"Step failed: {e}")
-    print("\n=== DEMO TESTS ===")
-    if dry:
-        print("Demo ran in dry-run mode. Use --execute for real."); return
-    try:
-        ma, mb = load_meta(a['name']), load_meta(b['name'])
-        gw_a = next(s['gw'] for s in ma['subnets'] if s['name'] == 'public')
-        gw_b = next(s['gw'] for s in mb['subnets'] if s['name'] == 'public')
-        ns_from = next(s['ns'] for s in ma['subnets'] if s['name'] == 'private')
-        print(f"Test: {ns_from} -> {gw_a}:8080")
-        test_connectivity(argparse.Namespace(target=gw_a, port=8080, from_ns=ns_from, dry=False))
-        print(f"Test: {ns_from} -> {gw_b}:8080 (post-peering)")
-        test_connectivity(argparse.Namespace(target=gw_b, port=8080, from_ns=ns_from, dry=False))
-    except Exception as e:
-        print(f"Demo checks skipped/failed: {e}")
-
-
-# ------------------------------------------------------------------
-# Flag / parser helpers
-# ------------------------------------------------------------------
-
-def build_parser():
-    p = argparse.ArgumentParser(prog="vpcctl", description="Minimal VPC controller (refined)")
-    p.add_argument("--dry-run", dest="dry", action="store_true", help="Print commands without running")
-    sub = p.add_subparsers(dest="cmd")
-    pc = sub.add_parser("create", help="Create a VPC")
-    pc.add_argument("name"); pc.add_argument("cidr", nargs="?")
-    pc.add_argument("--cidr", dest="cidr_flag")
-    pa = sub.add_parser("add-subnet", help="Add a subnet to a VPC")
-    pa.add_argument("vpc"); pa.add_argument("name"); pa.add_argument("cidr", nargs="?")
-    pa.add_argument("--cidr", dest="cidr_flag"); pa.add_argument("--gw", dest="gw")
-    sub.add_parser("list", help="List VPCs")
-    pi = sub.add_parser("inspect", help="Inspect a VPC"); pi.add_argument("name")
-    pd = sub.add_parser("delete", help="Delete a VPC"); pd.add_argument("name")
-    pn = sub.add_parser("enable-nat", help="Enable NAT for a VPC")
-    pn.add_argument("name"); pn.add_argument("iface", nargs="?")
-    pn.add_argument("--interface", dest="iface_flag"); pn.add_argument("--subnet", dest="subnet")
-    pn.add_argument("--all-subnets", dest="all_subnets", action="store_true")
-    pp = sub.add_parser("peer", help="Peer two VPCs")
-    pp.add_argument("vpc1"); pp.add_argument("vpc2"); pp.add_argument("--allow-cidrs", dest="allow_cidrs")
-    pol = sub.add_parser("apply-policy", help="Apply subnet policy JSON")
-    pol.add_argument("vpc"); pol.add_argument("policy_file")
-    pdp = sub.add_parser("deploy-app", help="Deploy HTTP server")
-    pdp.add_argument("vpc"); pdp.add_argument("subnet"); pdp.add_argument("port", nargs="?", default=8080, type=int)
-    pdp.add_argument("--port", dest="port_flag", type=int)
-    psa = sub.add_parser("stop-app", help="Stop app (by ns or pid)")
-    psa.add_argument("vpc"); psa.add_argument("--ns", dest="ns"); psa.add_argument("--pid", dest="pid")
-    pt = sub.add_parser("test-connectivity", help="Test connectivity")
-    pt.add_argument("target"); pt.add_argument("port", nargs="?", default=80, type=int)
-    pt.add_argument("--from-ns", dest="from_ns")
-    sub.add_parser("cleanup-all", help="Delete all VPCs")
-    sub.add_parser("verify", help="Report related resources")
-    demo = sub.add_parser("run-demo", help="Run demo (dry-run default)")
-    demo.add_argument("--execute", action="store_true")
-    demo.add_argument("--internet-iface", dest="iface")
-    sub.add_parser("flag-check", help="Validate flags only")
-    return p
-
-
-def run_flag_check():
-    _ = build_parser(); print("flag-check: parser built successfully")
-
-
-# ------------------------------------------------------------------
-# Dispatch + main
-# ------------------------------------------------------------------
-
-def _ensure_dry(args):
-    if not hasattr(args, "dry"): args.dry = False
-
-
-DISPATCH: Dict[str, Callable] = {
-    "create": create_vpc,
-    "add-subnet": add_subnet,
-    "list": list_command,
-    "inspect": inspect_command,
-    "delete": delete_vpc,
-    "enable-nat": enable_nat,
-    "apply-policy": apply_policy,
-    "deploy-app": deploy_app,
-    "stop-app": stop_app,
-    "test-connectivity": test_connectivity,
-    "cleanup-all": cleanup_all,
-    "verify": verify,
-    "peer": create_peer,
-    "run-demo": run_demo,
-    "flag-check": lambda _a: run_flag_check(),
-}
-
-
-def main():
-    parser = build_parser(); args = parser.parse_args(); _ensure_dry(args)
-    cmd = getattr(args, "cmd", None)
-    if not cmd: parser.print_help(); sys.exit(0)
-    h = DISPATCH.get(cmd)
-    if not h: parser.print_help(); sys.exit(2)
-    h(args)
-
-
-if __name__ == "__main__":  # pragma: no cover (entry point)
-    main()
+#!/usr/bin/env python3
+"""vpcctl - single-host VPC 
+
+This script is my practical toolkit for creating reproducible, isolated VPC-like
+environments on a single Linux host. It uses network namespaces, veth pairs and
+bridges plus iptables for access control. The design goals were:
+
+- Be small and explicit: each operation can print the commands it runs
+    (`--verbose`, always under `--dry-run`) and stores a minimal JSON metadata
+    file in `.vpcctl_data/` so the state is reproducible.
+- Keep operations idempotent where reasonable (creation skips existing things,
+    iptables rules are checked before insertion).
+- Make cleanup deterministic: metadata records host-level iptables commands so
+    delete can try to remove exactly what was added.
+
+File organization (logical parts)
+1) Small helpers and filesystem/arg parsing utilities
+2) iptables helpers (existence checks, comment injection, add/delete wrappers)
+3) Core VPC lifecycle: create_vpc, add_subnet, delete_vpc, cleanup_all
+4) Features: enable_nat, create_peer, apply_policy
+5) App lifecycle: deploy_app, stop_app, test_connectivity
+6) Verification, demo orchestration and CLI wiring
+
+Important safety notes
+- This script must be run as root. It modifies host networking (interfaces, rules)
+    and can break connectivity if misused. Use `--dry-run` to preview commands.
+- iptables comment matching is relied upon for robust deletion; if you manually
+    edit rules, delete may not remove them automatically.
+"""
+
+from __future__ import annotations
+
+import contextlib, copy, functools, hashlib, json, os, re, signal, subprocess, sys, threading, shutil, shlex
+from pathlib import Path
+from types import SimpleNamespace
+from typing import TYPE_CHECKING, List, Dict, Any, Callable, Optional, Sequence
+
+if TYPE_CHECKING:  # argparse/sqlite3 are only imported when a parser/the index is built
+    import argparse
+    import sqlite3
+
+try:  # optional C JSON codec; metadata I/O falls back to the stdlib
+    import orjson
+except ImportError:
+    orjson = None
+
+WORKDIR = Path.cwd() / ".vpcctl_data"
+WORKDIR.mkdir(parents=True, exist_ok=True)
+
+# Packet-filter backend for per-VPC isolation. nftables is opt-in
+# (VPCCTL_BACKEND=nft): each VPC gets its own table, so delete is one atomic
+# `nft delete table` instead of rule-by-rule iptables removal. Requires
+# nft >= 0.9.4 and kernel >= 5.6 (interval sets over concatenations).
+BACKEND = "nft" if os.environ.get("VPCCTL_BACKEND") == "nft" and shutil.which("nft") else "iptables"
+
+# Echo every command before running it (--verbose); dry-run always echoes
+VERBOSE = False
+
+# Seconds iptables waits for the xtables lock instead of failing with exit 4
+# when another writer (or a parallel cleanup worker) holds it
+IPTABLES_WAIT = "5"
+
+# ------------------------------------------------------------------
+# Generic utilities
+# ------------------------------------------------------------------
+
+def _xt_wait(cmd: List[str]) -> List[str]:
+    """Insert `-w IPTABLES_WAIT` after the iptables/iptables-restore binary in `cmd`."""
+    for i, t in enumerate(cmd):
+        if t in ("iptables", "iptables-restore"):
+            if cmd[i + 1:i + 2] == ["-w"]: return cmd
+            return cmd[:i + 1] + ["-w", IPTABLES_WAIT] + cmd[i + 1:]
+    return cmd
+
+
+_PRINT_LOCK = threading.Lock()
+
+# With an absolute argv[0] (see _resolve) and close_fds=False, subprocess
+# launches via posix_spawn (vfork-style) instead of fork+exec. Python opens
+# fds non-inheritable (PEP 446), so nothing extra leaks into the child.
+_SPAWN = {"close_fds": False}
+
+
+def run(cmd: List[str], *, check: bool = True, capture_output: bool = False, dry: bool = False):
+    """Run a command (queued instead while a CommandBatcher is active)."""
+    cmd = _xt_wait(cmd)
+    if _BATCHER is not None and not capture_output:
+        _BATCHER.add(cmd, check=check); return None
+    if VERBOSE or dry:
+        with _PRINT_LOCK: print(">>>", shlex.join(cmd))
+    if dry:
+        return None
+    return subprocess.run(_resolve(cmd), check=check, capture_output=capture_output, **_SPAWN)
+
+
+def run_input(cmd: List[str], data: str, *, check: bool = True, dry: bool = False):
+    """Like run(), but feeds `data` on stdin (restore/batch style tools)."""
+    cmd = _xt_wait(cmd)
+    if _BATCHER is not None:
+        _BATCHER.add(cmd, data=data, check=check); return None
+    if VERBOSE or dry:
+        with _PRINT_LOCK:  # keep a heredoc in one piece when cleanup-all runs in threads
+            print(">>>", shlex.join(cmd), "<<EOF")
+            print(data, end="" if data.endswith("\n") else "\n")
+            print("EOF")
+    if dry:
+        return None
+    return subprocess.run(_resolve(cmd), input=data, text=True, check=check, **_SPAWN)
+
+
+class CommandBatcher:
+    """Collects the commands issued through run()/run_input() into one shell
+    script and executes it with a single `bash -e` instead of a fork per command.
+
+    While `active()`, every run()/run_input() call is queued rather than
+    executed; `check=False` commands get `|| true` so they cannot abort the script.
+    Metadata for VPCs created (or explicitly staged) while active is held by
+    stage_meta() and only written by save_staged() once the caller knows the
+    script succeeded.
+    """
+    EOF_MARK = "VPCCTL_EOF"
+
+    def __init__(self):
+        self.lines: List[str] = []
+        self.staged: Dict[str, Dict[str, Any]] = {}
+
+    def stage_meta(self, name: str, meta: Dict[str, Any]):
+        """Hold a VPC's metadata in memory; later vpc_meta() blocks edit it in place."""
+        self.staged[name] = meta
+        _OPEN_META[name] = meta
+
+    def save_staged(self, ok: bool):
+        """Release staged metadata: write it if `ok`, otherwise drop it unwritten."""
+        for name, meta in self.staged.items():
+            _OPEN_META.pop(name, None)
+            if ok: save_meta(name, meta)
+        self.staged = {}
+
+    def add(self, cmd: List[str], *, data: Optional[str] = None, check: bool = True):
+        line = shlex.join(cmd)
+        if data is not None:
+            line = f"{line} <<'{self.EOF_MARK}'\n{data}{'' if data.endswith(chr(10)) else chr(10)}{self.EOF_MARK}"
+            # `|| true` must follow the heredoc body: on the command line it
+            # would bind the heredoc to `true` and leave cmd reading the script.
+            if not check: line = f"{{ {line}\n}} || true"
+        elif not check:
+            line += " || true"
+        self.lines.append(line)
+
+    @contextlib.contextmanager
+    def active(self):
+        global _BATCHER
+        prev, _BATCHER = _BATCHER, self
+        try:
+            yield self
+        finally:
+            _BATCHER = prev
+
+    def commit(self, dry: bool):
+        if not self.lines:
+            return None
+        script = "\n".join(self.lines) + "\n"
+        self.lines = []
+        if VERBOSE or dry:
+            print(">>> bash -e <<SCRIPT"); print(script, end=""); print("SCRIPT")
+        if dry:
+            return None
+        return subprocess.run(["bash", "-e"], input=script, text=True, check=True)
+
+
+_BATCHER: Optional[CommandBatcher] = None
+
+
+def _resolve(cmd: List[str]) -> List[str]:
+    """Swap argv[0] for its cached absolute path so exec skips the PATH search."""
+    path = _which(cmd[0])
+    return [path] + cmd[1:] if path else cmd
+
+
+def ip_batch(lines: List[str], dry: bool, *, netns: Optional[str] = None, force: bool = False):
+    """Run several `ip` subcommands in a single process (`ip -batch -`).
+
+    With `netns`, ip enters that namespace once (`ip -n <ns>`) and runs every
+    line there, instead of one `ip netns exec` per command. With `force`, ip
+    keeps going past failing lines (best-effort teardown) and the exit status
+    is not checked.
+    """
+    if not lines:
+        return None
+    cmd = ["ip", "-n", netns] if netns else ["ip"]
+    cmd += ["-force", "-batch", "-"] if force else ["-batch", "-"]
+    try:
+        return run_input(cmd, "\n".join(lines) + "\n", check=not force, dry=dry)
+    finally:
+        _host_state_changed()
+
+
+def require_root():
+    if os.geteuid() != 0:
+        print("vpcctl: must be run as root (sudo)")
+        sys.exit(2)
+
+
+REQUIRED_CMDS = ("ip", "iptables", "iptables-restore", "iptables-save", "sysctl")
+
+
+@functools.lru_cache(maxsize=None)
+def _which(cmd: str) -> Optional[str]:
+    """shutil.which, resolved once per binary per process."""
+    return shutil.which(cmd)
+
+
+@functools.lru_cache(maxsize=1)
+def check_commands() -> List[str]:
+    """Return the required host binaries that are missing from PATH."""
+    return [c for c in REQUIRED_CMDS if not _which(c)]
+
+
+_IFNAME_BAD = re.compile(r"[^A-Za-z0-9-]")
+_IFNAME_DASHES = re.compile(r"-{2,}")
+
+
+def safe_ifname(parts, prefix="", suffix="", maxlen: int = 15):
+    """Return safe interface name: join parts, sanitize, truncate."""
+    parts = parts if isinstance(parts, (list, tuple)) else (parts,)
+    core = "-".join(str(p) for p in parts if p is not None)
+    core = _IFNAME_BAD.sub("-", core)
+    core = _IFNAME_DASHES.sub("-", core)
+    avail = maxlen - len(prefix) - len(suffix)
+    if avail <= 0:
+        return (prefix + suffix)[:maxlen]
+    if len(core) > avail:
+        core = core[:avail]
+    return f"{prefix}{core}{suffix}"
+
+
+# ------------------------------------------------------------------
+# Metadata helpers
+# ------------------------------------------------------------------
+
+def _meta_path(name: str) -> Path:
+    return WORKDIR / f"vpc_{name}.json"
+
+
+def vpc_exists(name: str) -> bool:
+    return name in _OPEN_META or _meta_path(name).exists()
+
+
+def _json_loads(data: bytes):
+    return orjson.loads(data) if orjson else json.loads(data)
+
+
+def _json_dumps(obj) -> bytes:
+    if orjson:
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2)
+    return json.dumps(obj, indent=2).encode()
+
+
+# Version 2 keys "subnets" by subnet name and "peers" by peer VPC name
+# (version 1 stored both as lists).
+SCHEMA_VERSION = 2
+
+
+def _migrate_meta(meta: Dict[str, Any]) -> Dict[str, Any]:
+    if meta.get("schema_version", 1) < 2:
+        subs = meta.get("subnets") or []
+        if isinstance(subs, list):
+            meta["subnets"] = {s["name"]: s for s in subs if s.get("name")}
+        peers = meta.get("peers") or []
+        if isinstance(peers, list):
+            meta["peers"] = {p["peer_vpc"]: p for p in peers if p.get("peer_vpc")}
+        meta["schema_version"] = SCHEMA_VERSION
+    return meta
+
+
+# name -> (st_mtime_ns, st_size, parsed metadata); callers get deep copies so
+# the cached dict is never mutated behind our back.
+_META_CACHE: Dict[str, tuple] = {}
+
+
+def load_meta(name: str) -> Dict[str, Any]:
+    if name in _OPEN_META:  # inside a vpc_meta() block: see its unsaved edits
+        return copy.deepcopy(_OPEN_META[name])
+    p = _meta_path(name)
+    try:
+        st = p.stat()
+    except FileNotFoundError:
+        _META_CACHE.pop(name, None)
+        raise FileNotFoundError(p)
+    hit = _META_CACHE.get(name)
+    if hit and hit[0] == st.st_mtime_ns and hit[1] == st.st_size:
+        return copy.deepcopy(hit[2])
+    meta = _migrate_meta(_json_loads(p.read_bytes()))
+    _META_CACHE[name] = (st.st_mtime_ns, st.st_size, meta)
+    return copy.deepcopy(meta)
+
+
+def save_meta(name: str, meta: Dict[str, Any]):
+    # Write-then-rename: a crash mid-write never leaves a truncated JSON file
+    path = _meta_path(name)
+    tmp = path.with_suffix(".json.tmp")
+    tmp.write_bytes(_json_dumps(meta))
+    os.replace(tmp, path)
+    st = path.stat()
+    _META_CACHE[name] = (st.st_mtime_ns, st.st_size, copy.deepcopy(meta))
+    _index_vpc(name, meta)
+
+
+# VPC name -> metadata dict of the outermost open vpc_meta() block
+_OPEN_META: Dict[str, Dict[str, Any]] = {}
+
+
+@contextlib.contextmanager
+def vpc_meta(name: str, *, save: bool = True):
+    """Load a VPC's metadata for one operation and write it back once, atomically.
+
+    Nothing is written if the block raises (or exits), or if the metadata was
+    not changed. Nested blocks for the same VPC share the outer dict and leave
+    the write to the outermost one, so a multi-step flow saves once.
+    """
+    if name in _OPEN_META:
+        yield _OPEN_META[name]
+        return
+    meta = load_meta(name)
+    original = copy.deepcopy(meta)
+    _OPEN_META[name] = meta
+    try:
+        yield meta
+    finally:
+        _OPEN_META.pop(name, None)
+    if save and meta != original:
+        save_meta(name, meta)
+
+
+def drop_meta(name: str):
+    _META_CACHE.pop(name, None)
+    try: _meta_path(name).unlink()
+    except Exception: pass
+    with _DB_LOCK, _db() as db:
+        for table, col in (("vpc", "name"), ("subnet", "vpc"), ("host_rule", "vpc"), ("source", "name")):
+            db.execute(f"DELETE FROM {table} WHERE {col} = ?", (name,))
+
+
+def list_vpcs() -> List[str]:
+    with _DB_LOCK:
+        return [r[0] for r in _db().execute("SELECT name FROM vpc ORDER BY name")]
+
+
+# ------------------------------------------------------------------
+# sqlite index (list/verify lookups without opening every JSON file)
+# ------------------------------------------------------------------
+
+_INDEX_SCHEMA = """
+CREATE TABLE IF NOT EXISTS vpc (name TEXT PRIMARY KEY, cidr TEXT, bridge TEXT, chain TEXT);
+CREATE TABLE IF NOT EXISTS subnet (vpc TEXT, name TEXT, ns TEXT, cidr TEXT, PRIMARY KEY (vpc, name));
+CREATE INDEX IF NOT EXISTS subnet_ns ON subnet (ns);
+CREATE TABLE IF NOT EXISTS host_rule (vpc TEXT, tokens_json TEXT, comment TEXT);
+CREATE TABLE IF NOT EXISTS source (name TEXT PRIMARY KEY, mtime_ns INTEGER, size INTEGER);
+"""
+_DB: Optional[sqlite3.Connection] = None
+# One shared connection; cleanup_all's worker threads serialize on this lock
+_DB_LOCK = threading.RLock()
+
+
+def _db() -> sqlite3.Connection:
+    """Open (once) WORKDIR/index.db, reconciled against the JSON files."""
+    global _DB
+    with _DB_LOCK:
+        if _DB is None:
+            import sqlite3  # deferred: flag-check/--help never touch the index
+            path = WORKDIR / "index.db"
+            _DB = sqlite3.connect(str(path), check_same_thread=False)
+            _DB.executescript(_INDEX_SCHEMA)
+            _reconcile_index()
+    return _DB
+
+
+def _reconcile_index():
+    """Bring the index in line with the vpc_*.json files, which stay the source of truth.
+
+    Rows whose file is gone are dropped; files that are new, or whose
+    mtime/size differ from what was indexed (edited by hand, written by an
+    older vpcctl), are re-indexed. Runs once per process, when the index is
+    opened; costs one glob and a stat per VPC.
+    """
+    db = _db()
+    on_disk = {}
+    for p in WORKDIR.glob("vpc_*.json"):
+        try: st = p.stat()
+        except FileNotFoundError: continue
+        on_disk[p.stem.replace("vpc_", "", 1)] = (st.st_mtime_ns, st.st_size)
+    indexed = {r[0]: (r[1], r[2]) for r in db.execute(
+        "SELECT vpc.name, source.mtime_ns, source.size FROM vpc LEFT JOIN source ON source.name = vpc.name")}
+    for name in indexed.keys() - on_disk.keys():
+        drop_meta(name)
+    for name, stamp in on_disk.items():
+        if indexed.get(name) != stamp:
+            try: _index_vpc(name, load_meta(name))
+            except Exception as e: print(f"Warning: could not index vpc_{name}.json: {e}")
+
+
+def _index_vpc(name: str, meta: Dict[str, Any]):
+    """Replace the index rows for one VPC in a single transaction."""
+    with _DB_LOCK, _db() as db:
+        db.execute("INSERT OR REPLACE INTO vpc VALUES (?, ?, ?, ?)",
+                   (name, meta.get("cidr"), meta.get("bridge"), meta.get("chain")))
+        db.execute("DELETE FROM subnet WHERE vpc = ?", (name,))
+        db.executemany("INSERT INTO subnet VALUES (?, ?, ?, ?)",
+                       [(name, s.get("name"), s.get("ns"), s.get("cidr")) for s in meta.get("subnets", {}).values()])
+        db.execute("DELETE FROM host_rule WHERE vpc = ?", (name,))
+        db.executemany("INSERT INTO host_rule VALUES (?, ?, ?)",
+                       [(name, json.dumps(r), _rule_comment(r)) for r in meta.get("host_iptables", [])])
+        try:
+            st = _meta_path(name).stat()
+            db.execute("INSERT OR REPLACE INTO source VALUES (?, ?, ?)", (name, st.st_mtime_ns, st.st_size))
+        except FileNotFoundError:
+            db.execute("DELETE FROM source WHERE name = ?", (name,))
+
+
+def recorded_namespaces() -> set:
+    with _DB_LOCK:
+        return {r[0] for r in _db().execute("SELECT ns FROM subnet")}
+
+
+# ------------------------------------------------------------------
+# Host state queries (sysfs / netns dir, no `ip` forks)
+# ------------------------------------------------------------------
+
+SYS_NET = Path("/sys/class/net")
+NETNS_DIR = Path("/var/run/netns")
+
+
+# The three host-state readers below are memoized per invocation; anything
+# that adds or removes links/namespaces calls _host_state_changed().
+def _host_state_changed():
+    for f in (_link_names, _bridge_names, _netns_names):
+        f.cache_clear()
+
+
+@functools.lru_cache(maxsize=1)
+def _link_names() -> frozenset:
+    """Interface names in the host namespace (exact names, not a text blob)."""
+    try:
+        return frozenset(os.listdir(SYS_NET))
+    except OSError:
+        out = subprocess.run(["ip", "-o", "link", "show"], capture_output=True, text=True).stdout or ""
+        return frozenset(ln.split(":")[1].strip().split("@")[0] for ln in out.splitlines() if ln.count(":") >= 2)
+
+
+@functools.lru_cache(maxsize=1)
+def _bridge_names() -> frozenset:
+    try:
+        return frozenset(n for n in os.listdir(SYS_NET) if (SYS_NET / n / "bridge").is_dir())
+    except OSError:
+        out = subprocess.run(["ip", "-o", "link", "show", "type", "bridge"], capture_output=True, text=True).stdout or ""
+        return frozenset(ln.split(":")[1].strip() for ln in out.splitlines() if ln.count(":") >= 2)
+
+
+@functools.lru_cache(maxsize=1)
+def _netns_names() -> frozenset:
+    try:
+        return frozenset(os.listdir(NETNS_DIR))
+    except FileNotFoundError:
+        return frozenset()  # created by the first `ip netns add`
+    except OSError:
+        out = subprocess.run(["ip", "netns", "list"], capture_output=True, text=True).stdout or ""
+        return frozenset(ln.split()[0] for ln in out.splitlines() if ln.strip())
+
+
+# ------------------------------------------------------------------
+# iptables helpers
+# ------------------------------------------------------------------
+
+_RESTORE_BAD = re.compile(r'["\'\\\s]')
+
+
+def _restore_join(tokens: Sequence[str]) -> str:
+    """Join tokens into an iptables-restore rule line.
+
+    iptables-restore splits on whitespace and only knows double quotes (no
+    POSIX single quotes, so shlex.join output is wrong here). Tokens with
+    embedded spaces are double-quoted; quotes, backslashes and other
+    whitespace (newlines) are refused, as they could end the line or inject
+    another one. Raises ValueError for such tokens.
+    """
+    out = []
+    for t in tokens:
+        if not t or _RESTORE_BAD.search(t.replace(" ", "")):
+            raise ValueError(f"unsafe iptables token: {t!r}")
+        out.append(f'"{t}"' if " " in t else t)
+    return " ".join(out)
+
+
+class Rule:
+    """One host iptables rule, kept as its parts so rendering never has to
+    search an argv for `-j` or copy it to splice in the comment match."""
+    __slots__ = ("chain", "spec", "target", "comment", "table", "verb")
+
+    def __init__(self, chain: str, spec: tuple, target: str, comment: Optional[str] = None,
+                 table: str = "filter", verb: str = "-A"):
+        self.chain, self.spec, self.target = chain, spec, target
+        self.comment, self.table, self.verb = comment, table, verb
+
+    def _body(self, verb: str) -> List[str]:
+        tail = ["-m", "comment", "--comment", self.comment] if self.comment else []
+        return [verb, self.chain, *self.spec, *tail, "-j", self.target]
+
+    def argv(self, verb: Optional[str] = None) -> List[str]:
+        """`iptables ...` argv (the form recorded in host_iptables)."""
+        head = ["iptables"] if self.table == "filter" else ["iptables", "-t", self.table]
+        return head + self._body(verb or self.verb)
+
+    def restore_line(self) -> str:
+        return _restore_join(self._body(self.verb))
+
+
+def _iptables_rule_exists(rule: Rule) -> bool:
+    try:
+        r = subprocess.run(_resolve(_xt_wait(rule.argv("-C"))), check=False, capture_output=True, **_SPAWN)
+        return r.returncode == 0
+    except Exception:
+        return False
+
+
+_RULE_TOKEN_RE = re.compile(r'"([^"]*)"|(\S+)')
+
+
+def _split_rule(line: str) -> List[str]:
+    """Tokenize one `iptables -S`/`iptables-save` rule line.
+
+    Those lines only ever quote whole tokens (the comment), so a plain split
+    or one regex pass gives the same tokens as shlex.split at a fraction of
+    the cost; lines with backslash escapes still go through shlex.
+    """
+    if '"' not in line:
+        return line.split()
+    if '\\' in line:
+        return shlex.split(line)
+    return [q if u is None else u for q, u in (m.groups() for m in _RULE_TOKEN_RE.finditer(line))]
+
+
+# iptables-save/-S print some matches differently from how they were added:
+# `-m state --state A,B` may come back as `-m conntrack --ctstate B,A`.
+_TOKEN_ALIASES = {"state": "conntrack", "--state": "--ctstate"}
+
+
+def _token_set(toks) -> frozenset:
+    """Rule tokens normalized for comparison: spelling aliases folded and
+    comma-separated lists (state sets, port lists) sorted."""
+    return frozenset(",".join(sorted(t.split(","))) if "," in t else _TOKEN_ALIASES.get(t, t) for t in toks)
+
+
+def iptables_snapshot(tables: Sequence[str] = ("nat", "filter")) -> Dict[str, Dict[str, List[frozenset]]]:
+    """One `iptables-save` for every table: {table: {chain: [rule token sets]}}."""
+    try:
+        out = subprocess.run(_resolve(["iptables-save"]), capture_output=True, text=True).stdout or ''
+    except Exception:
+        out = ''
+    snap: Dict[str, Dict[str, List[frozenset]]] = {t: {} for t in tables}
+    cur = None
+    for line in out.splitlines():
+        if line.startswith('*'):
+            cur = snap.get(line[1:])
+        elif cur is not None and line.startswith('-A '):
+            toks = _split_rule(line)
+            cur.setdefault(toks[1], []).append(_token_set(toks))
+    return snap
+
+
+def _rule_in(rules: Sequence[frozenset], cmd: List[str]) -> bool:
+    # `-S` reorders matches relative to how we build them, so compare token
+    # sets; the comment marker is kept in the key to stay specific.
+    comment = _rule_comment(cmd)
+    want = _token_set(_rule_key(cmd) + [comment] if comment else _rule_key(cmd))
+    return any(want <= r for r in rules)
+
+
+def _name_digest(*parts: str) -> str:
+    """Short stable digest of names, for kernel object names that get truncated."""
+    return hashlib.sha1("\0".join(parts).encode()).hexdigest()[:8]
+
+
+def _vpc_chain(name: str) -> str:
+    # The readable prefix is truncated, so the digest of the full name keeps
+    # VPCs sharing a prefix (production-a/-b) on different chains. <= 28 chars.
+    return f"vpc-{safe_ifname([name], maxlen=14)}-{_name_digest(name)}"
+
+
+def _chain_owner(chain: str) -> Optional[str]:
+    """VPC whose intra rule sits in `chain`: None if the chain does not exist,
+    "" if it exists without one (an empty leftover)."""
+    try:
+        r = subprocess.run(_resolve(_xt_wait(["iptables", "-S", chain])), capture_output=True, text=True)
+    except Exception:
+        return None
+    if r.returncode != 0:
+        return None
+    for line in r.stdout.splitlines():
+        comment = _rule_comment(_split_rule(line)) if line.startswith("-A ") else None
+        if comment and comment.startswith("vpcctl:") and comment.endswith(":intra"):
+            return comment[len("vpcctl:"):-len(":intra")]
+    return ""
+
+
+def _peer_ipset(vpc1: str, vpc2: str) -> str:
+    # Named from a digest of the unordered pair, not the joined names:
+    # "a-b"+"c" vs "a"+"b-c", or two long names cut to the same prefix,
+    # must not share a set. <= 31 chars (ipset's limit).
+    a, b = sorted((vpc1, vpc2))
+    return f"vpcctl-p-{safe_ifname([a, b], maxlen=12)}-{_name_digest(a, b)}"
+
+
+def _ipset_exists(name: str) -> bool:
+    try:
+        return subprocess.run(_resolve(["ipset", "list", "-t", name]), capture_output=True).returncode == 0
+    except Exception:
+        return False
+
+
+def _rule_chain(cmd: List[str]) -> Optional[str]:
+    for i, t in enumerate(cmd[:-1]):
+        if t in ('-A', '-I'): return cmd[i + 1]
+    return None
+
+
+class IptablesBatch:
+    """Rules staged per table in memory and committed with one
+    `iptables-restore --noflush` covering every table touched.
+
+    With a `snapshot` (from iptables_snapshot) existence checks are done in
+    Python; without one each checked rule falls back to `iptables -C`. Rules
+    already staged in this batch, or going into a chain the batch declares
+    (and therefore starts empty), need no check at all.
+    """
+
+    def __init__(self, snapshot: Optional[Dict[str, Dict[str, List[frozenset]]]] = None):
+        self.snapshot = snapshot
+        self.lines: Dict[str, List[str]] = {}
+        self._seen: set = set()
+        self._declared: set = set()
+
+    def chain(self, name: str, table: str = "filter"):
+        """Declare `name` (`:name - [0:0]`): creates it, or flushes a stale copy."""
+        self.lines.setdefault(table, []).insert(0, f":{name} - [0:0]")
+        self._declared.add((table, name))
+
+    def append(self, rule: Rule, *, check: bool = True) -> Optional[List[str]]:
+        """Stage `rule` unless it already exists; return the argv to record, or None."""
+        try:
+            line = rule.restore_line()
+        except ValueError as e:
+            print(f"iptables: {e}"); sys.exit(1)
+        use = rule.argv()
+        key = (rule.table, tuple(_rule_key(use)))
+        if key in self._seen:
+            return None
+        self._seen.add(key)
+        if check and (rule.table, rule.chain) not in self._declared:
+            if self.snapshot is not None:
+                exists = _rule_in(self.snapshot.get(rule.table, {}).get(rule.chain, []), use)
+            else:
+                exists = _iptables_rule_exists(rule)
+            if exists:
+                print("iptables: rule exists, skipping:", " ".join(use))
+                return None
+        self.lines.setdefault(rule.table, []).append(line)
+        return use
+
+    def commit(self, dry: bool):
+        sections = list(self.lines.items())
+        self.lines = {}
+        return iptables_commit(sections, dry)
+
+
+def iptables_batch(table: str, lines: List[str], dry: bool, *, chains: Sequence[str] = ()):
+    """Apply many rules with a single `iptables-restore --noflush` (one table commit).
+
+    `chains` are declared as `:chain - [0:0]`, which creates them or flushes them
+    if they already exist, so re-running a batch stays idempotent.
+    """
+    if not lines and not chains:
+        return None
+    return iptables_commit([(table, [f":{c} - [0:0]" for c in chains] + lines)], dry)
+
+
+def iptables_commit(sections: Sequence[tuple], dry: bool):
+    """One `iptables-restore --noflush` for several (table, lines) sections."""
+    payload = []
+    for table, lines in sections:
+        if lines:
+            payload += [f"*{table}"] + lines + ["COMMIT"]
+    if not payload:
+        return None
+    return run_input(["iptables-restore", "--noflush"], "\n".join(payload) + "\n", dry=dry)
+
+
+# Token tables for _rule_key: tokens dropped outright, and options whose
+# value(s) are skipped along with them.
+_IPTABLES_DROP = frozenset(('iptables', '-A', '-I', '-D'))
+_IPTABLES_SKIP = {'-t': 1, '-w': 1, '--comment': 1}
+
+
+def _rule_key(cmd: List[str]) -> List[str]:
+    """Tokens identifying a recorded rule: drops binary, table, verb and comment."""
+    key = []
+    i, n = 0, len(cmd)
+    while i < n:
+        t = cmd[i]
+        if t in _IPTABLES_DROP:
+            i += 1
+        elif t == '-m' and i + 1 < n and cmd[i + 1] == 'comment':
+            i += 2
+        elif t in _IPTABLES_SKIP:
+            i += 1 + _IPTABLES_SKIP[t]
+        else:
+            key.append(t); i += 1
+    return key
+
+
+def _rule_table(cmd: List[str]) -> str:
+    return cmd[cmd.index('-t') + 1] if '-t' in cmd[:-1] else 'filter'
+
+
+def _rule_comment(cmd: List[str]) -> Optional[str]:
+    return cmd[cmd.index('--comment') + 1] if '--comment' in cmd[:-1] else None
+
+
+_COMMENT_RE = re.compile(r'--comment (?:"([^"]*)"|(\S+))')
+
+
+Snapshot = Dict[str, Dict[str, List[tuple]]]
+
+
+def _snapshot_iptables(tables=('filter', 'nat', 'mangle')) -> Snapshot:
+    """Dump each table once; index commented rules as {table: {comment: [(tokens, token_set)]}}."""
+    snap: Snapshot = {}
+    for table in tables:
+        try:
+            out = subprocess.run(_xt_wait(['iptables', '-t', table, '-S']), capture_output=True, text=True).stdout or ''
+        except Exception:
+            out = ''
+        idx: Dict[str, List[tuple]] = {}
+        for line in out.splitlines():
+            m = _COMMENT_RE.search(line)
+            if m:
+                toks = _split_rule(line)
+                idx.setdefault(m.group(1) or m.group(2), []).append((toks, _token_set(toks)))
+        snap[table] = idx
+    return snap
+
+
+def _delete_rules(rules: List[List[str]], *, dry: bool):
+    """Delete recorded rules using one `-S` snapshot and one restore per table."""
+    if dry:
+        for r in rules: print("(dry) would delete:", r)
+        return
+    snap = _snapshot_iptables(tuple(sorted({_rule_table(r) for r in rules})))
+    per_table: Dict[str, List[str]] = {}
+    batched: Dict[str, List[List[str]]] = {}
+    missed: List[List[str]] = []
+    for r in rules:
+        table = _rule_table(r); key_set = _token_set(_rule_key(r))
+        pool = snap.get(table, {}).get(_rule_comment(r) or '', [])
+        hit = next((e for e in pool if key_set <= e[1]), None)
+        if hit is None:
+            missed.append(r); continue
+        try:
+            line = _restore_join(['-D'] + hit[0][1:])
+        except ValueError:
+            missed.append(r); continue
+        pool.remove(hit)
+        per_table.setdefault(table, []).append(line)
+        batched.setdefault(table, []).append(r)
+    for table, lines in per_table.items():
+        try:
+            iptables_batch(table, lines, dry)
+        except subprocess.CalledProcessError:
+            # Only the rules this restore carried; the rest are already in `missed`
+            missed.extend(batched[table])
+    # Anything not found by comment goes through the slow per-rule heuristics
+    for r in missed:
+        try: _delete_rule(r, dry=dry)
+        except Exception: pass
+
+
+def _delete_rule(cmd: List[str], *, dry: bool) -> bool:
+    """Delete one recorded rule: exact `-D` first, then by the spec listed in one `-S <chain>`."""
+    if dry:
+        print("(dry) would delete:", cmd)
+        return True
+    exact = cmd.copy()
+    for i, t in enumerate(exact):
+        if t in ("-A", "-I"):
+            exact[i] = "-D"; break
+    # `-D` fails by itself when the rule is absent, so no separate `-C` probe
+    try:
+        run(exact, check=True, capture_output=True); return True
+    except Exception:
+        pass
+    table, chain = _rule_table(cmd), _rule_chain(cmd)
+    comment = _rule_comment(cmd)
+    if not (chain and comment):
+        return False  # without our comment marker a listed rule could be the user's
+    try:
+        out = subprocess.run(_xt_wait(['iptables', '-t', table, '-S', chain]),
+                             capture_output=True, text=True).stdout or ''
+    except Exception:
+        return False
+    # The listing may order matches differently from the recorded argv, so
+    # compare token sets (comment included) and delete by the listed spec, not
+    # by rule number: cleanup-all deletes from shared chains concurrently, so
+    # numbers can shift between listing and deleting.
+    key_set = _token_set(_rule_key(cmd) + [comment])
+    for line in out.splitlines():
+        if not line.startswith('-A '):
+            continue
+        toks = _split_rule(line)
+        if _rule_comment(toks) == comment and key_set <= _token_set(toks):
+            try:
+                run(['iptables', '-t', table, '-D'] + toks[1:], check=True); return True
+            except Exception:
+                return False
+    return False
+
+
+# ------------------------------------------------------------------
+# nftables helpers
+# ------------------------------------------------------------------
+
+def _nft_table(name: str) -> str:
+    # The digest keeps names that sanitize alike ("a-b", "a_b") apart
+    return "vpcctl_" + "".join(c if c.isalnum() else "_" for c in name) + "_" + _name_digest(name)
+
+
+def _nft_elements(pairs) -> str:
+    return ", ".join(f"{s} . {d}" for s, d in pairs)
+
+
+def nft_apply(lines: List[str], dry: bool):
+    """Apply nft commands as one atomic transaction (`nft -f -`)."""
+    return run_input(["nft", "-f", "-"], "\n".join(lines) + "\n", dry=dry)
+
+
+def _nft_vpc_lines(table: str, bridge: str, cidr: str) -> List[str]:
+    # Traffic leaving the bridge is accepted when (saddr, daddr) is in @allowed;
+    # anything else headed for another VPC bridge is dropped. The set starts with
+    # the intra-VPC pair and peering adds elements to it. An interval set over
+    # a concatenation needs nft >= 0.9.4 and kernel >= 5.6 (see README).
+    return [
+        f"add table inet {table}",
+        f"add set inet {table} allowed {{ type ipv4_addr . ipv4_addr; flags interval; }}",
+        f"add element inet {table} allowed {{ {_nft_elements([(cidr, cidr)])} }}",
+        f"add chain inet {table} forward {{ type filter hook forward priority 0; policy accept; }}",
+        f'add rule inet {table} forward iifname "{bridge}" ip saddr . ip daddr @allowed accept',
+        f'add rule inet {table} forward iifname "{bridge}" oifname "br-*" drop',
+    ]
+
+
+# ------------------------------------------------------------------
+# Small internal helpers
+# ------------------------------------------------------------------
+
+@functools.lru_cache(maxsize=256)
+def _ip_network(cidr: str):
+    # Network objects are immutable, so the same CIDR (VPC ranges, peering
+    # allow-lists) is parsed once per run. ipaddress is imported here so
+    # commands that never parse a CIDR (list, inspect, stop-app...) skip it.
+    import ipaddress
+    return ipaddress.ip_network(cidr)
+
+
+def _parse_network(cidr: str):
+    try:
+        return _ip_network(cidr)
+    except Exception as e:
+        print(f"Invalid CIDR: {cidr}: {e}"); sys.exit(1)
+
+
+def _cross_pairs(allow: Sequence[str], src_cidr: Optional[str], dst_cidr: Optional[str]) -> List[tuple]:
+    """(src, dst) pairs from `allow` that can actually cross from src_cidr to dst_cidr.
+
+    Pairs whose source cannot lie in the sending VPC or whose destination
+    cannot lie in the receiving one never match (intra-VPC traffic is already
+    accepted by the VPC's own rule), so they are not emitted. Without both
+    VPC CIDRs every pair is kept.
+    """
+    if not (src_cidr and dst_cidr):
+        return [(s, d) for s in allow for d in allow]
+    a, b = _ip_network(src_cidr), _ip_network(dst_cidr)
+    srcs = [c for c in allow if _ip_network(c).overlaps(a)]
+    dsts = [c for c in allow if _ip_network(c).overlaps(b)]
+    return [(s, d) for s in srcs for d in dsts]
+
+
+@functools.lru_cache(maxsize=256)
+def _subnet_addresses(cidr: str) -> Optional[tuple]:
+    """(first, second, prefixlen) usable addresses of a CIDR, or None if too small.
+
+    Derived by arithmetic from the cached network; never materializes hosts().
+    """
+    net = _ip_network(cidr)
+    base = net.network_address
+    if net.num_addresses >= 4:
+        return str(base + 1), str(base + 2), net.prefixlen
+    if net.num_addresses == 2:  # /31 point-to-point: both addresses usable
+        return str(base), str(base + 1), net.prefixlen
+    return None
+
+
+def _find_subnet(meta: Dict[str, Any], *, name: Optional[str] = None, cidr: Optional[str] = None):
+    subnets = meta.get("subnets", {})
+    if name: return subnets.get(name)
+    if cidr: return _subnets_by_cidr(meta).get(cidr)
+    return None
+
+
+def _subnets_by_cidr(meta: Dict[str, Any]) -> Dict[str, Dict[str, Any]]:
+    """CIDR -> subnet record; build once when looking up many CIDRs."""
+    return {s["cidr"]: s for s in meta.get("subnets", {}).values() if s.get("cidr")}
+
+
+def _term_app(app: Dict[str, Any], *, dry: bool):
+    """SIGTERM an app in-process: its whole session via killpg when the pgid is
+    recorded (deploy-app starts each server in its own session), else the pid."""
+    pid, pgid = app.get("pid"), app.get("pgid")
+    if not pid: return
+    if dry:
+        print(">>>", f"kill -TERM -{pgid}" if pgid else f"kill -TERM {pid}"); return
+    try:
+        if pgid: os.killpg(int(pgid), signal.SIGTERM)
+        else: os.kill(int(pid), signal.SIGTERM)
+    except (ProcessLookupError, PermissionError, ValueError):
+        pass
+
+
+# ------------------------------------------------------------------
+# Core lifecycle
+# ------------------------------------------------------------------
+
+def create_vpc(args):
+    # Ensure default isolation: block all forwarding by default
+    if BACKEND == "iptables":
+        run(["iptables", "-P", "FORWARD", "DROP"], dry=args.dry)
+    name = args.name
+    cidr = args.cidr
+    dry = args.dry
+    _parse_network(cidr)
+    if vpc_exists(name):
+        print(f"VPC '{name}' already exists (idempotent).")
+        return
+    bridge = safe_ifname([name], prefix="br-", maxlen=15)
+    ip_batch([f"link add name {bridge} type bridge", f"link set {bridge} up"], dry)
+    run(["sysctl", "-w", "net.ipv4.ip_forward=1"], dry=dry)
+    host_rules, chain, table = [], None, None
+    if BACKEND == "nft":
+        table = _nft_table(name)
+        nft_apply(_nft_vpc_lines(table, bridge, cidr), dry)
+    else:
+        chain = _vpc_chain(name)
+        owner = _chain_owner(chain)
+        if owner and owner != name:
+            print(f"iptables chain '{chain}' already belongs to VPC '{owner}'; refusing to flush it"); sys.exit(1)
+        # Chain declaration, jump and intra-VPC accept go in as one restore commit;
+        # declaring the chain flushes a leftover copy of this VPC's own chain,
+        # so only the jump needs a check.
+        batch = IptablesBatch()
+        batch.chain(chain)
+        rec = batch.append(Rule("FORWARD", ("-i", bridge), chain, f"vpcctl:{name}:jump", verb="-I"))
+        if rec: host_rules.append(rec)
+        host_rules.append(batch.append(Rule(chain, ("-s", cidr, "-d", cidr), "ACCEPT", f"vpcctl:{name}:intra")))
+        batch.commit(dry)
+    meta = {"schema_version": SCHEMA_VERSION, "name": name, "cidr": cidr, "bridge": bridge, "subnets": {},
+            "host_iptables": host_rules, "chain": chain, "apps": [], "peers": {}}
+    if table:
+        meta["nft_table"] = table
+    # Do not persist state in dry-run; keep dry-run side-effect free
+    if dry:
+        print("(dry-run) metadata not written for VPC create")
+    elif _BATCHER is not None:
+        _BATCHER.stage_meta(name, meta)  # commands are only queued; write once they ran
+    else:
+        save_meta(name, meta)
+    print(f"Created VPC '{name}' with bridge '{bridge}' and CIDR {cidr}")
+
+
+def add_subnet(args):
+    vpc = args.vpc; sub_name = args.name
+    cidr = args.cidr
+    dry = args.dry
+    if not vpc_exists(vpc):
+        print(f"VPC '{vpc}' not found. Create it first."); sys.exit(1)
+    _parse_network(cidr)
+    addrs = _subnet_addresses(cidr)
+    if addrs is None:
+        print(f"CIDR {cidr} too small for gateway+host"); sys.exit(1)
+    first, second, prefix = addrs
+    with vpc_meta(vpc, save=not dry) as meta:
+        bridge = meta["bridge"]
+        # Compute namespace name early for repair checks
+        ns = f"ns-{vpc}-{sub_name}"
+        # If metadata says the subnet exists, verify the namespace truly exists; if not, repair
+        existing = meta.get("subnets", {}).get(sub_name)
+        if existing:
+            if ns in _netns_names():
+                print(f"Subnet '{sub_name}' already exists in VPC '{vpc}' (idempotent).")
+                return
+            else:
+                print(f"Subnet '{sub_name}' recorded but namespace missing; repairing…")
+        v_host_base = f"v-{vpc}-{sub_name}".replace('/', '-')
+        v_peer_base = f"vbr-{vpc}-{sub_name}".replace('/', '-')
+        # Collision avoidance: manual suffix insertion preserving uniqueness within 15 char Linux ifname limit.
+        # Earlier approach using safe_ifname truncated away numeric suffixes (e.g. both 'public' and 'private' -> 'vbr-prod-test-p').
+        # Here we truncate base keeping room for suffix explicitly.
+        existing_names = _link_names() if not dry else set()
+        def mk_with_suffix(base: str, suffix: str) -> str:
+            limit = 15
+            if len(base) + len(suffix) <= limit:
+                return base + suffix
+            return base[:limit - len(suffix)] + suffix
+        for attempt in range(10):
+            suffix = '' if attempt == 0 else str(attempt)
+            v_host = mk_with_suffix(v_host_base, suffix)
+            v_peer = mk_with_suffix(v_peer_base, suffix)
+            if v_host not in existing_names and v_peer not in existing_names:
+                break
+        else:
+            print(f"Could not find a free veth name for {v_host_base}"); sys.exit(1)
+        # Host-side plumbing in one `ip` process instead of five forks
+        ip_batch([f"netns add {ns}",
+                  f"link add {v_host} type veth peer name {v_peer}",
+                  f"link set {v_peer} master {bridge}",
+                  f"link set {v_peer} up",
+                  f"link set {v_host} netns {ns}"], dry)
+        if getattr(args, 'gw', None):
+            bridge_gw = args.gw
+            host_ip = second if first == bridge_gw else first
+        else:
+            bridge_gw, host_ip = first, second
+        run(["ip", "addr", "add", f"{bridge_gw}/{prefix}", "dev", bridge], check=False, dry=dry)
+        ip_batch([f"addr add {host_ip}/{prefix} dev {v_host}",
+                  f"link set {v_host} up",
+                  "link set lo up",
+                  f"route add default via {bridge_gw}"], dry, netns=ns)
+        # Persist only when not dry; update existing record if repairing
+        if existing:
+            existing.update({"cidr": cidr, "ns": ns, "gw": bridge_gw, "host_ip": host_ip, "veth": v_host})
+        else:
+            meta.setdefault("subnets", {})[sub_name] = {"name": sub_name, "cidr": cidr, "ns": ns, "gw": bridge_gw,
+                                                         "host_ip": host_ip, "veth": v_host}
+    if dry:
+        print("(dry-run) metadata not written for add-subnet")
+    # Policy merge (preserves original behavior, just factored)
+    try:
+        _merge_and_apply_policy(vpc, sub_name, cidr, dry)
+    except Exception as e:
+        print(f"Warning: policy merge/apply failed: {e}")
+    print(f"Created subnet '{sub_name}' ({cidr}) in VPC '{vpc}' ns='{ns}' gw={bridge_gw}")
+
+
+def _merge_and_apply_policy(vpc: str, sub_name: str, cidr: str, dry: bool):
+    default_path = WORKDIR / f"policy_{vpc}_default.json"
+    subnet_path = WORKDIR / f"policy_{vpc}_{sub_name}_{cidr.replace('/', '_')}.json"
+    if not subnet_path.exists():
+        policy = {"subnet": cidr, "ingress": [
+            {"port": 80, "protocol": "tcp", "action": "allow"},
+            {"port": 443, "protocol": "tcp", "action": "allow"},
+            {"port": 22, "protocol": "tcp", "action": "deny"}], "egress": []}
+        subnet_path.write_bytes(_json_dumps(policy))
+    merged: List[Dict[str, Any]] = []
+    if default_path.exists():
+        try:
+            dp = _json_loads(default_path.read_bytes())
+            if isinstance(dp, dict): dp = [dp]
+            for e in dp:
+                e = dict(e)
+                if not e.get("subnet") or e.get("subnet") in ("*", cidr):
+                    e["subnet"] = cidr; merged.append(e)
+        except Exception as e:
+            print(f"Warning: read default policy failed: {e}")
+    try:
+        sp = _json_loads(subnet_path.read_bytes())
+        if isinstance(sp, dict): sp = [sp]
+        for e in sp:
+            ee = dict(e); ee["subnet"] = cidr; merged.append(ee)
+    except Exception as e:
+        print(f"Warning: read subnet policy failed: {e}")
+    merged_path = WORKDIR / f"policy_{vpc}_{sub_name}_{cidr.replace('/', '_')}_merged.json"
+    merged_path.write_bytes(_json_dumps(merged[0] if len(merged) == 1 else merged))
+    if dry:
+        print(f"Would apply merged policy (dry-run): {merged_path}")
+        return
+    # The merged file is kept as a record; the policy itself is passed in
+    # memory rather than re-read and re-parsed.
+    apply_policy(SimpleNamespace(vpc=vpc, policy_obj=merged, dry=dry))
+    print(f"Applied merged policy -> {merged_path}")
+
+
+def list_command(args):
+    vpcs = list_vpcs()
+    if not vpcs:
+        print("No VPCs found"); return
+    for v in vpcs: print(v)
+
+
+def inspect_command(args):
+    name = args.name
+    try:
+        meta = load_meta(name)
+    except FileNotFoundError:
+        print(f"VPC '{name}' not found"); return
+    print(json.dumps(meta, indent=2))
+
+
+_EMPTY_NS_TABLES = ("*filter\n:INPUT ACCEPT [0:0]\n:FORWARD ACCEPT [0:0]\n:OUTPUT ACCEPT [0:0]\nCOMMIT\n"
+                    "*nat\n:PREROUTING ACCEPT [0:0]\n:INPUT ACCEPT [0:0]\n:OUTPUT ACCEPT [0:0]\n"
+                    ":POSTROUTING ACCEPT [0:0]\nCOMMIT\n")
+
+
+def delete_vpc(args):
+    name = args.name; dry = args.dry
+    if not vpc_exists(name):
+        # Still drop any index row left behind by a JSON file removed by hand
+        drop_meta(name)
+        print(f"VPC '{name}' not found; nothing to delete."); return
+    meta = load_meta(name)
+    for app in meta.get("apps", []):
+        _term_app(app, dry=dry)
+    bridge = meta.get("bridge")
+    ip_lines: List[str] = []
+    for s in meta.get("subnets", {}).values():
+        ns = s.get("ns")
+        # One restore of empty filter+nat tables replaces `iptables -F` and `-t nat -F`
+        run_input(["ip", "netns", "exec", ns, "iptables-restore"], _EMPTY_NS_TABLES, check=False, dry=dry)
+        ip_lines.append(f"netns del {ns}")
+    # Namespaces and bridge go in one best-effort `ip -force -batch`
+    ip_lines += [f"link set {bridge} down", f"link del {bridge} type bridge"]
+    ip_batch(ip_lines, dry, force=True)
+    chain = meta.get("chain")
+    # Rules inside the VPC's own chain go away with the chain flush below
+    host_rules = [r for r in meta.get("host_iptables", []) if chain not in r[:4]]
+    if host_rules:
+        _delete_rules(host_rules, dry=dry)
+    if meta.get("nft_table"):
+        run(["nft", "delete", "table", "inet", meta["nft_table"]], check=False, dry=dry)
+    if chain:
+        run(["iptables", "-D", "FORWARD", "-i", bridge, "-j", chain], check=False, dry=dry)
+        run(["iptables", "-F", chain], check=False, dry=dry)
+        run(["iptables", "-X", chain], check=False, dry=dry)
+    # Peer sets are shared with the other VPC's chain; destroy fails (harmlessly)
+    # while that side still references it and succeeds when it is deleted too.
+    for pset in meta.get("ipsets", []):
+        run(["ipset", "destroy", pset], check=False, dry=dry)
+    if not dry:
+        drop_meta(name)
+    print(f"Deleted VPC '{name}' and cleaned up resources")
+
+
+def cleanup_all(args):
+    dry = args.dry
+    vpcs = list_vpcs()
+    if not vpcs:
+        print("No VPCs to clean up"); return
+    # VPCs own disjoint bridges/namespaces/chains, so teardown runs in parallel;
+    # iptables calls carry -w and queue on the xtables lock.
+    def _delete(v: str):
+        try:
+            delete_vpc(SimpleNamespace(name=v, dry=dry))
+        except Exception as e:
+            print(f"Failed to delete VPC '{v}': {e}")
+    from concurrent.futures import ThreadPoolExecutor  # deferred: only cleanup-all needs it
+    # Capped at 8: beyond that workers mostly queue on the xtables lock
+    with ThreadPoolExecutor(max_workers=min(len(vpcs), 8)) as ex:
+        list(ex.map(_delete, vpcs))
+    print("All recorded VPCs cleaned up")
+
+
+def verify(args):
+    vpc_ns = sorted(n for n in _netns_names() if n.startswith("ns-"))
+    bridges = sorted(b for b in _bridge_names() if b.startswith("br-"))
+    print("vpcctl-looking namespaces:", vpc_ns)
+    print("vpcctl-looking bridges:", bridges)
+    recorded = list_vpcs()
+    print("Recorded VPCs:", recorded)
+    known = recorded_namespaces()
+    orphans = [ns for ns in vpc_ns if ns not in known]
+    print("Orphan namespaces (no metadata):", orphans if orphans else "None")
+
+
+def create_peer(args):
+    vpc1, vpc2, dry = args.vpc1, args.vpc2, args.dry
+    if vpc1 == vpc2:
+        print("Cannot peer a VPC to itself"); sys.exit(1)
+    if not (vpc_exists(vpc1) and vpc_exists(vpc2)):
+        print("Both VPCs must exist to create a peer"); sys.exit(1)
+    # Both metadata files are committed together, and only if peering succeeds
+    with vpc_meta(vpc1, save=not dry) as m1, vpc_meta(vpc2, save=not dry) as m2:
+        _peer_vpcs(args, m1, m2)
+
+
+def _peer_vpcs(args, m1: Dict[str, Any], m2: Dict[str, Any]):
+    vpc1, vpc2, dry = args.vpc1, args.vpc2, args.dry
+    b1, b2 = m1["bridge"], m2["bridge"]
+    allow = [c.strip() for c in args.allow_cidrs.split(',')] if args.allow_cidrs else [m1.get("cidr"), m2.get("cidr")]
+    for c in allow: _parse_network(c)
+    veth_a = safe_ifname([vpc1, vpc2], prefix="pv-", suffix="a", maxlen=15)
+    veth_b = safe_ifname([vpc1, vpc2], prefix="pv-", suffix="b", maxlen=15)
+    links = _link_names()
+    if veth_a not in links and veth_b not in links:
+        ip_batch([f"link add {veth_a} type veth peer name {veth_b}",
+                  f"link set {veth_a} master {b1}",
+                  f"link set {veth_b} master {b2}",
+                  f"link set {veth_a} up",
+                  f"link set {veth_b} up"], dry)
+    # Only cross-VPC pairs, per direction: vpc1 -> vpc2 and vpc2 -> vpc1.
+    fwd = _cross_pairs(allow, m1.get("cidr"), m2.get("cidr"))
+    rev = _cross_pairs(allow, m2.get("cidr"), m1.get("cidr"))
+    t1, t2 = m1.get("nft_table"), m2.get("nft_table")
+    if t1 or t2:
+        if not (t1 and t2):
+            print("Cannot peer an nftables VPC with an iptables VPC"); sys.exit(1)
+        nft_apply([f"add element inet {t} allowed {{ {_nft_elements(pairs)} }}"
+                   for t, pairs in ((t1, fwd), (t2, rev)) if pairs], dry)
+        _record_peers(m1, m2, vpc1, vpc2, veth_a, veth_b, allow, None)
+        return
+    c1, c2 = m1.get("chain"), m2.get("chain")
+    if not (c1 and c2):
+        print("Per-VPC chains not found; ensure VPCs were created by vpcctl")
+    # Cross-VPC ACCEPTs plus both DROPs is committed in a single restore;
+    # idempotency is checked against one iptables-save dump.
+    batch = IptablesBatch(iptables_snapshot(("filter",)))
+    pset = None
+    # (rule, recording metadata) in insertion order
+    rules: List[tuple] = []
+    if _which("ipset"):
+        # One hash:net,net set holds every (src,dst) pair: a single O(1) set
+        # match per chain instead of len(allow)^2 linear ACCEPT rules.
+        pset = _peer_ipset(vpc1, vpc2)
+        if pset not in m1.get("ipsets", []) and _ipset_exists(pset):
+            # `-exist` below would silently merge this allow-list into it
+            print(f"ipset '{pset}' already exists and is not this peering's; refusing to reuse it"); sys.exit(1)
+        entries = [f"create {pset} hash:net,net -exist"]
+        entries += [f"add {pset} {src},{dst} -exist" for src, dst in dict.fromkeys(fwd + rev)]
+        run_input(["ipset", "restore"], "\n".join(entries) + "\n", dry=dry)
+        for c, b, m in ((c1, b2, m1), (c2, b1, m2)):
+            rules.append((Rule(c, ("-o", b, "-m", "set", "--match-set", pset, "src,dst"), "ACCEPT",
+                               f"vpcctl:peer:{vpc1}:{vpc2}"), m))
+            if pset not in m.setdefault("ipsets", []): m["ipsets"].append(pset)
+    else:
+        print("vpcctl: optional 'ipset' not found; using per-pair ACCEPT rules")
+        for c, b, m, pairs in ((c1, b2, m1, fwd), (c2, b1, m2, rev)):
+            for src, dst in pairs:
+                rules.append((Rule(c, ("-o", b, "-s", src, "-d", dst), "ACCEPT",
+                                   f"vpcctl:peer:{vpc1}:{vpc2}"), m))
+    for c, b, m in ((c1, b2, m1), (c2, b1, m2)):
+        rules.append((Rule(c, ("-o", b), "DROP", f"vpcctl:peer-drop:{vpc1}:{vpc2}"), m))
+    staged = [(batch.append(rule), m) for rule, m in rules]
+    batch.commit(dry)
+    for rec, m in staged:
+        if rec: m.setdefault("host_iptables", []).append(rec)
+    _record_peers(m1, m2, vpc1, vpc2, veth_a, veth_b, allow, pset)
+
+
+def _record_peers(m1, m2, vpc1, vpc2, veth_a, veth_b, allow, pset):
+    pr = {"peer_vpc": vpc2, "veth_a": veth_a, "veth_b": veth_b, "allowed": allow, "ipset": pset}
+    m1.setdefault("peers", {}).setdefault(vpc2, pr)
+    pr_rev = {"peer_vpc": vpc1, "veth_a": veth_b, "veth_b": veth_a, "allowed": allow, "ipset": pset}
+    m2.setdefault("peers", {}).setdefault(vpc1, pr_rev)
+    print(f"Peered '{vpc1}' <-> '{vpc2}' via {veth_a}/{veth_b}. Allowed: {allow}")
+
+
+def enable_nat(args):
+    name = args.name
+    intf = getattr(args, 'iface_flag', None) or getattr(args, 'iface', None)
+    target_subnet = getattr(args, 'subnet', None)
+    all_subnets = getattr(args, 'all_subnets', False)
+    dry = args.dry
+    if not vpc_exists(name):
+        print(f"VPC '{name}' not found"); sys.exit(1)
+    with vpc_meta(name, save=not dry) as meta:
+        bridge, vpc_cidr = meta.get("bridge"), meta.get("cidr")
+        subnets = meta.get("subnets", {})
+        run(["sysctl", "-w", "net.ipv4.ip_forward=1"], dry=dry)
+        cidrs: List[str] = []
+        if all_subnets:
+            cidrs = [s["cidr"] for s in subnets.values() if s.get("cidr")]
+            if not cidrs and vpc_cidr: cidrs = [vpc_cidr]
+        elif target_subnet:
+            s = subnets.get(target_subnet)
+            if s and s.get("cidr"): cidrs.append(s["cidr"])
+        else:
+            cidrs = [s["cidr"] for s in subnets.values()
+                     if str(s.get("name", "")).lower() == "public" and s.get("cidr")]
+        if not cidrs:
+            print("No subnets matched for NAT (try --subnet or --all-subnets). Leaving NAT unchanged.")
+        else:
+            # MASQUERADE and both FORWARD rules go in one restore spanning nat
+            # and filter; existence is checked against one iptables-save dump.
+            batch = IptablesBatch(iptables_snapshot(("nat", "filter")))
+            recs: List[Optional[List[str]]] = []
+            for c in cidrs:
+                recs.append(batch.append(Rule("POSTROUTING", ("-s", c, "-o", intf), "MASQUERADE",
+                                              f"vpcctl:{name}:nat:{c}", table="nat")))
+            recs.append(batch.append(Rule("FORWARD", ("-i", bridge, "-o", intf), "ACCEPT", f"vpcctl:{name}:fwd-out")))
+            recs.append(batch.append(Rule("FORWARD", ("-i", intf, "-o", bridge, "-m", "state", "--state", "ESTABLISHED,RELATED"),
+                                          "ACCEPT", f"vpcctl:{name}:fwd-in")))
+            batch.commit(dry)
+            new_entries = [r for r in recs if r]
+            if new_entries: meta.setdefault("host_iptables", []).extend(new_entries)
+        meta["nat"] = {"interface": intf, "cidrs": cidrs}
+    print((f"Enabled NAT for '{name}' via '{intf}' -> {cidrs}" if cidrs else f"No CIDRs NATed for '{name}'"))
+
+
+# Policy action -> iptables target; anything other than "allow" drops
+POLICY_ACTIONS = {"allow": "ACCEPT", "deny": "DROP"}
+# Only these reach iptables-restore, which has no quoting of its own; tcp/udp
+# rules match a port, icmp/all rules match the whole protocol.
+POLICY_PORT_PROTOCOLS = ("tcp", "udp")
+POLICY_PROTOCOLS = POLICY_PORT_PROTOCOLS + ("icmp", "all")
+
+
+def _policy_port(port) -> Optional[str]:
+    """`port` as an iptables --dport token (N or LO:HI, 1-65535), or None if invalid."""
+    if isinstance(port, bool):
+        return None
+    if isinstance(port, int):
+        parts = [port]
+    else:
+        try:
+            parts = [int(p) for p in str(port).split(":")]
+        except ValueError:
+            return None
+    if len(parts) > 2 or not all(1 <= p <= 65535 for p in parts) or parts != sorted(parts):
+        return None
+    return ":".join(str(p) for p in parts)
+
+
+def _policy_rules(entries: List[Dict[str, Any]], key: str) -> List[tuple]:
+    """Validate ingress/egress entries once into (proto, port or None, target) tuples."""
+    rules = []
+    for r in entries:
+        proto = str(r.get("protocol", "tcp")).lower()
+        if proto not in POLICY_PROTOCOLS:
+            print(f"Skipping {key} rule with unsupported protocol {r.get('protocol')!r}"); continue
+        port = None
+        if proto in POLICY_PORT_PROTOCOLS:
+            if r.get("port") is None: print(f"Skipping {key} without port"); continue
+            port = _policy_port(r["port"])
+            if port is None:
+                print(f"Skipping {key} rule with invalid port {r['port']!r}"); continue
+        rules.append((proto, port, POLICY_ACTIONS.get(str(r.get("action", "allow")).lower(), "DROP")))
+    return rules
+
+
+def apply_policy(args):
+    vpc = args.vpc; dry = args.dry
+    if not vpc_exists(vpc): print(f"VPC '{vpc}' not found"); sys.exit(1)
+    # Internal callers hand over an already-built policy; the CLI reads a file.
+    pol = getattr(args, "policy_obj", None)
+    if pol is None:
+        try:
+            pol = _json_loads(Path(args.policy_file).read_bytes())
+        except Exception as e:
+            print(f"Failed to read policy file: {e}"); sys.exit(1)
+    if isinstance(pol, dict): pol = [pol]
+    by_cidr = _subnets_by_cidr(load_meta(vpc))
+    for p in pol:
+        scidr = p.get("subnet")
+        if not scidr:
+            print("Policy missing 'subnet'; skipping"); continue
+        target = by_cidr.get(scidr)
+        if not target:
+            print(f"No subnet in VPC '{vpc}' matches {scidr}; skipping"); continue
+        ns = target.get("ns")
+        # The whole filter table is replaced in one atomic iptables-restore
+        # (no --noflush), which also covers the old `iptables -F`.
+        lines = ["*filter", ":INPUT ACCEPT [0:0]", ":FORWARD ACCEPT [0:0]", ":OUTPUT ACCEPT [0:0]",
+                 "-A INPUT -i lo -j ACCEPT",
+                 "-A INPUT -m state --state ESTABLISHED,RELATED -j ACCEPT"]
+        for chain, key in (("INPUT", "ingress"), ("OUTPUT", "egress")):
+            lines += [f"-A {chain} -p {proto}{f' --dport {port}' if port else ''} -j {target}"
+                      for proto, port, target in _policy_rules(p.get(key, []), key)]
+        lines.append("COMMIT")
+        run_input(["ip", "netns", "exec", ns, "iptables-restore"], "\n".join(lines) + "\n", dry=dry)
+        print(f"Applied policy to {scidr} (ns {ns})")
+
+
+def deploy_app(args):
+    vpc = args.vpc; subnet = args.subnet; port = getattr(args,'port_flag', None) or getattr(args,'port', None)
+    dry = args.dry
+    if not vpc_exists(vpc): print(f"VPC '{vpc}' not found"); sys.exit(1)
+    with vpc_meta(vpc, save=not dry) as meta:
+        target = _find_subnet(meta, name=subnet)
+        if not target: print(f"Subnet '{subnet}' not found in VPC '{vpc}'"); sys.exit(1)
+        ns = target.get("ns")
+        # -I -S: http.server is pure stdlib, so skip site/user-site setup at startup
+        cmd = ["ip","netns","exec",ns,"python3","-I","-S","-m","http.server",str(port)]
+        print(f"Starting HTTP server in {ns} port {port}")
+        if dry: print("DRY:", " ".join(cmd)); return
+        logpath = f"/tmp/vpcctl-{ns}-http.log"
+        try:
+            # No shell: start_new_session detaches like nohup, and since
+            # `ip netns exec` execs the server in place, proc.pid is the server's pid.
+            logfd = os.open(logpath, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+            try:
+                proc = subprocess.Popen(_resolve(cmd), stdin=subprocess.DEVNULL, stdout=logfd,
+                                        stderr=subprocess.STDOUT, start_new_session=True, close_fds=True)
+            finally:
+                os.close(logfd)
+            pid = proc.pid
+            print(f"HTTP server started ns={ns} pid={pid} log={logpath}")
+            # start_new_session makes the server its own process-group leader
+            meta.setdefault("apps", []).append({"ns": ns, "port": port, "pid": pid, "pgid": pid, "cmd": cmd})
+        except Exception as e:
+            print(f"Failed to start HTTP server: {e}")
+
+
+def stop_app(args):
+    vpc = args.vpc; ns = args.ns; pid = args.pid; dry = args.dry
+    if not vpc_exists(vpc): print(f"VPC '{vpc}' not found"); return
+    removed = []
+    with vpc_meta(vpc, save=not dry) as meta:
+        for app in list(meta.get("apps", [])):
+            if ns and app.get("ns") != ns: continue
+            if pid and str(app.get("pid")) != str(pid): continue
+            _term_app(app, dry=dry)
+            meta.get("apps", []).remove(app); removed.append(app)
+    print(f"Stopped apps: {removed}" if removed else "No matching apps found to stop")
+
+
+def test_connectivity(args):
+    target, port, from_ns, dry = args.target, args.port, args.from_ns, args.dry
+    cmd = ["ip","netns","exec",from_ns,"curl","-sS",f"http://{target}:{port}"] if from_ns else ["curl","-sS",f"http://{target}:{port}"]
+    print("Testing connectivity:", " ".join(cmd))
+    if dry: return
+    try:
+        r = subprocess.run(_resolve(cmd), check=False, capture_output=True, timeout=5)
+        if r.returncode != 0:
+            print("Connectivity test failed (non-zero exit)"); return
+        # Only the snapshot is shown, so decode just that slice
+        print("Connectivity OK — response snapshot:\n", r.stdout[:200].decode('ascii', 'replace'))
+    except Exception as e:
+        print(f"Connectivity test error: {e}")
+
+
+def test_connectivity_batch(ns: Optional[str], targets: List[tuple], dry: bool) -> Dict[str, str]:
+    """Probe several (host, port) targets with one parallel curl; returns {url: http_code}."""
+    urls = [f"http://{t}:{p}/" for t, p in targets]
+    cmd = ["curl", "--parallel", "--parallel-immediate", "-sS", "--max-time", "5",
+           "-w", "%{url_effective} %{http_code}\n"]
+    for u in urls: cmd += ["-o", "/dev/null", u]  # -o applies to one URL each
+    if ns: cmd = ["ip", "netns", "exec", ns] + cmd
+    print("Testing connectivity:", shlex.join(cmd))
+    if dry: return {}
+    try:
+        r = subprocess.run(_resolve(cmd), check=False, capture_output=True, timeout=15)
+    except Exception as e:
+        print(f"Connectivity test error: {e}"); return {}
+    codes = dict(line.rsplit(" ", 1) for line in r.stdout.decode('ascii', 'replace').splitlines() if " " in line)
+    for u in urls:
+        code = codes.get(u, "000")
+        print(f"  {u} -> {'OK' if code[:1] in ('2', '3') else 'FAILED'} (HTTP {code})")
+    return codes
+
+
+# ------------------------------------------------------------------
+# Demo orchestration (kept same semantics)
+# ------------------------------------------------------------------
+
+def run_demo(args):
+    execute = args.execute; iface = args.iface; dry = not execute
+    if execute: require_root()
+    a = {"name": "demo-a", "cidr": "10.10.0.0/16", "public": "10.10.1.0/24", "private": "10.10.2.0/24"}
+    b = {"name": "demo-b", "cidr": "10.20.0.0/16", "public": "10.20.1.0/24"}
+    N = SimpleNamespace
+    # (label, handler, args): handlers are called directly, no re-dispatch by name
+    steps = [
+        (f"create {a['name']} {a['cidr']}", create_vpc, N(name=a['name'], cidr=a['cidr'], dry=dry)),
+        (f"add-subnet {a['name']} public {a['public']}", add_subnet, N(vpc=a['name'], name="public", cidr=a['public'], dry=dry)),
+        (f"add-subnet {a['name']} private {a['private']}", add_subnet, N(vpc=a['name'], name="private", cidr=a['private'], dry=dry)),
+        (f"create {b['name']} {b['cidr']}", create_vpc, N(name=b['name'], cidr=b['cidr'], dry=dry)),
+        (f"add-subnet {b['name']} public {b['public']}", add_subnet, N(vpc=b['name'], name="public", cidr=b['public'], dry=dry)),
+        (f"deploy-app {a['name']} public 8080", deploy_app, N(vpc=a['name'], subnet="public", port=8080, dry=dry)),
+    ]
+    if execute:
+        if not iface:
+            print("--internet-iface required with --execute"); return
+        steps.append((f"enable-nat {a['name']} {iface}", enable_nat, N(name=a['name'], iface=iface, dry=dry)))
+    allow = f"{a['public']},{b['public']}"
+    steps.append((f"peer {a['name']} {b['name']} --allow-cidrs {allow}", create_peer,
+                  N(vpc1=a['name'], vpc2=b['name'], allow_cidrs=allow, dry=dry)))
+    # Topology steps are queued into one script; deploy-app starts a process
+    # that needs its namespace to exist, so it flushes the queue first.
+    # Metadata of every VPC the demo touches is staged on the batcher and
+    # written once, after every queued command ran; if the script fails none
+    # is saved. On a re-run the VPCs already exist: staging them too keeps
+    # add-subnet/enable-nat/peer from saving before their commands ran.
+    batcher = CommandBatcher()
+    ok = False
+    try:
+        for name in (a['name'], b['name']):
+            if vpc_exists(name): batcher.stage_meta(name, load_meta(name))
+        for label, handler, step_args in steps:
+            print(f"\n=== STEP: {label} ===")
+            if handler is deploy_app:
+                try:
+                    batcher.commit(dry)
+                except subprocess.CalledProcessError as e:
+                    print(f"Step failed: {e}"); break
+            try:
+                if handler is deploy_app:
+                    handler(step_args)
+                    continue
+                with batcher.active():
+                    handler(step_args)
+            except (Exception, SystemExit) as e:  # handlers sys.exit() on bad input; keep the demo going
+                print(f"Step failed: {e}")
+        else:
+            try:
+                batcher.commit(dry); ok = True
+            except subprocess.CalledProcessError as e:
+                print(f"Step failed: {e}")
+    finally:
+        if not ok: print("Demo did not complete; metadata of its VPCs not updated")
+        batcher.save_staged(ok)
+    print("\n=== DEMO TESTS ===")
+    if dry:
+        print("Demo ran in dry-run mode. Use --execute for real."); return
+    try:
+        ma, mb = load_meta(a['name']), load_meta(b['name'])
+        gw_a = ma['subnets']['public']['gw']
+        gw_b = mb['subnets']['public']['gw']
+        ns_from = ma['subnets']['private']['ns']
+        print(f"Test: {ns_from} -> {gw_a}:8080 and {gw_b}:8080 (post-peering)")
+        test_connectivity_batch(ns_from, [(gw_a, 8080), (gw_b, 8080)], dry=False)
+    except Exception as e:
+        print(f"Demo checks skipped/failed: {e}")
+
+
+# ------------------------------------------------------------------
+# Flag / parser helpers
+# ------------------------------------------------------------------
+
+def _build_create(sub, **kw):
+    pc = sub.add_parser("create", help="Create a VPC", **kw)
+    pc.add_argument("name"); pc.add_argument("cidr", nargs="?", help="VPC CIDR (--cidr CIDR also accepted)")
+
+
+def _build_add_subnet(sub, **kw):
+    pa = sub.add_parser("add-subnet", help="Add a subnet to a VPC", **kw)
+    pa.add_argument("vpc"); pa.add_argument("name")
+    pa.add_argument("cidr", nargs="?", help="Subnet CIDR (--cidr CIDR also accepted)"); pa.add_argument("--gw", dest="gw")
+
+
+def _build_enable_nat(sub, **kw):
+    pn = sub.add_parser("enable-nat", help="Enable NAT for a VPC", **kw)
+    pn.add_argument("name"); pn.add_argument("iface", nargs="?")
+    pn.add_argument("--interface", dest="iface_flag"); pn.add_argument("--subnet", dest="subnet")
+    pn.add_argument("--all-subnets", dest="all_subnets", action="store_true")
+
+
+def _build_peer(sub, **kw):
+    pp = sub.add_parser("peer", help="Peer two VPCs", **kw)
+    pp.add_argument("vpc1"); pp.add_argument("vpc2"); pp.add_argument("--allow-cidrs", dest="allow_cidrs")
+
+
+def _build_apply_policy(sub, **kw):
+    pol = sub.add_parser("apply-policy", help="Apply subnet policy JSON", **kw)
+    pol.add_argument("vpc"); pol.add_argument("policy_file")
+
+
+def _build_deploy_app(sub, **kw):
+    pdp = sub.add_parser("deploy-app", help="Deploy HTTP server", **kw)
+    pdp.add_argument("vpc"); pdp.add_argument("subnet"); pdp.add_argument("port", nargs="?", default=8080, type=int)
+    pdp.add_argument("--port", dest="port_flag", type=int)
+
+
+def _build_stop_app(sub, **kw):
+    psa = sub.add_parser("stop-app", help="Stop app (by ns or pid)", **kw)
+    psa.add_argument("vpc"); psa.add_argument("--ns", dest="ns"); psa.add_argument("--pid", dest="pid")
+
+
+def _build_test_connectivity(sub, **kw):
+    pt = sub.add_parser("test-connectivity", help="Test connectivity", **kw)
+    pt.add_argument("target"); pt.add_argument("port", nargs="?", default=80, type=int)
+    pt.add_argument("--from-ns", dest="from_ns")
+
+
+def _build_run_demo(sub, **kw):
+    demo = sub.add_parser("run-demo", help="Run demo (dry-run default)", **kw)
+    demo.add_argument("--execute", action="store_true")
+    demo.add_argument("--internet-iface", dest="iface")
+
+
+# One builder per subcommand, in --help order; main() only needs the one
+# named on the command line.
+SUBPARSER_BUILDERS: Dict[str, Callable] = {
+    "create": _build_create,
+    "add-subnet": _build_add_subnet,
+    "list": lambda sub, **kw: sub.add_parser("list", help="List VPCs", **kw),
+    "inspect": lambda sub, **kw: sub.add_parser("inspect", help="Inspect a VPC", **kw).add_argument("name"),
+    "delete": lambda sub, **kw: sub.add_parser("delete", help="Delete a VPC", **kw).add_argument("name"),
+    "enable-nat": _build_enable_nat,
+    "peer": _build_peer,
+    "apply-policy": _build_apply_policy,
+    "deploy-app": _build_deploy_app,
+    "stop-app": _build_stop_app,
+    "test-connectivity": _build_test_connectivity,
+    "cleanup-all": lambda sub, **kw: sub.add_parser("cleanup-all", help="Delete all VPCs", **kw),
+    "verify": lambda sub, **kw: sub.add_parser("verify", help="Report related resources", **kw),
+    "run-demo": _build_run_demo,
+    "flag-check": lambda sub, **kw: sub.add_parser("flag-check", help="Validate flags only", **kw),
+}
+
+
+def _is_help_flag(tok: str) -> bool:
+    """-h, a short-option cluster containing it (-vh), or --help / an
+    unambiguous prefix of it (--he), all of which argparse treats as help."""
+    if tok.startswith("--"):
+        return len(tok) > 2 and "--help".startswith(tok)
+    return tok.startswith("-") and "h" in tok[1:]
+
+
+def _sniff_subcommand(argv: Sequence[str]) -> Optional[str]:
+    """The subcommand named in `argv`, or None (top-level help, typo, none given).
+
+    Global options take no values, so the first non-option token is the
+    subcommand position.
+    """
+    for tok in argv:
+        if tok.startswith("-"):
+            if _is_help_flag(tok): return None
+            continue
+        return tok if tok in SUBPARSER_BUILDERS else None
+    return None
+
+
+# Subcommands whose cidr may also be given as --cidr, with the options of
+# theirs that take a value.
+_CIDR_FLAG_CMDS: Dict[str, tuple] = {"create": (), "add-subnet": ("--gw",)}
+
+
+def _fold_cidr_flag(argv: Sequence[str]) -> List[str]:
+    """Rewrite `--cidr X` / `--cidr=X` after create/add-subnet into the
+    positional cidr, so those parsers need one action, not two."""
+    cmd = _sniff_subcommand(argv)
+    if cmd not in _CIDR_FLAG_CMDS:
+        return list(argv)
+    takes_value = _CIDR_FLAG_CMDS[cmd]
+    i = argv.index(cmd) + 1
+    head, pos, opts, cidr = list(argv[:i]), [], [], None
+    while i < len(argv):
+        t = argv[i]
+        if t == "--cidr" and i + 1 < len(argv):
+            cidr = argv[i + 1]; i += 2; continue
+        if t.startswith("--cidr="):
+            cidr = t[len("--cidr="):]
+        elif t in takes_value and i + 1 < len(argv):
+            opts += argv[i:i + 2]; i += 2; continue
+        else:
+            (opts if t.startswith("-") else pos).append(t)
+        i += 1
+    # cidr is the last positional, so it goes after the others and ahead of
+    # any options (argparse does not intermix optional positionals)
+    return head + pos + ([cidr] if cidr is not None else []) + opts
+
+
+def _wants_help(argv: Sequence[str]) -> bool:
+    return any(_is_help_flag(t) for t in argv)
+
+
+_PARSERS: Dict[tuple, argparse.ArgumentParser] = {}
+
+
+def build_parser(argv: Optional[Sequence[str]] = None):
+    """Return the CLI parser for `argv`, building it on first use only.
+
+    When argv names a subcommand only that subparser is registered, and
+    without its -h/--help action unless help was asked for; with no argv,
+    top-level help or an unknown command every subcommand is, so usage and
+    `invalid choice` messages stay complete.
+    """
+    cmd = _sniff_subcommand(argv) if argv is not None else None
+    if cmd == "flag-check":
+        cmd = None  # it validates the full parser, so build that one up front
+    full = (None, True)
+    if full in _PARSERS:
+        return _PARSERS[full]  # the full parser, once built, serves every command
+    key = (cmd, not cmd or _wants_help(argv))
+    if key not in _PARSERS:
+        _PARSERS[key] = _build_parser((cmd,) if cmd else tuple(SUBPARSER_BUILDERS), add_help=key[1])
+    return _PARSERS[key]
+
+
+def _build_parser(cmds: Sequence[str], *, add_help: bool = True):
+    import argparse
+    p = argparse.ArgumentParser(prog="vpcctl", description="Minimal VPC controller (refined)")
+    p.add_argument("--dry-run", dest="dry", action="store_true", help="Print commands without running")
+    p.add_argument("--verbose", "-v", action="store_true", help="Print each command before running it")
+    sub = p.add_subparsers(dest="cmd")
+    for name in cmds:
+        SUBPARSER_BUILDERS[name](sub, add_help=add_help)
+    # Each subcommand carries its handler, so main() is a single indirect call
+    for name, sp in sub.choices.items():
+        sp.set_defaults(func=DISPATCH[name])
+    return p
+
+
+def run_flag_check():
+    _ = build_parser(); print("flag-check: parser built successfully")
+
+
+# ------------------------------------------------------------------
+# Dispatch + main
+# ------------------------------------------------------------------
+
+DISPATCH: Dict[str, Callable] = {
+    "create": create_vpc,
+    "add-subnet": add_subnet,
+    "list": list_command,
+    "inspect": inspect_command,
+    "delete": delete_vpc,
+    "enable-nat": enable_nat,
+    "apply-policy": apply_policy,
+    "deploy-app": deploy_app,
+    "stop-app": stop_app,
+    "test-connectivity": test_connectivity,
+    "cleanup-all": cleanup_all,
+    "verify": verify,
+    "peer": create_peer,
+    "run-demo": run_demo,
+    "flag-check": lambda _a: run_flag_check(),
+}
+
+
+# Commands that touch host networking and therefore need the tools present
+HOST_CMDS = frozenset({"create", "add-subnet", "delete", "enable-nat", "apply-policy", "deploy-app", "stop-app",
+                       "peer", "cleanup-all"})
+
+
+def main():
+    global VERBOSE
+    argv = _fold_cidr_flag(sys.argv[1:])
+    parser = build_parser(argv); args = parser.parse_args(argv)
+    # --dry-run/--verbose default to False and the subparsers action to
+    # cmd=None; every subparser sets func, so no getattr fallbacks are needed.
+    cmd = args.cmd
+    if not cmd: parser.print_help(); sys.exit(0)
+    h = args.func
+    if args.verbose:
+        VERBOSE = True
+    if cmd in HOST_CMDS and not args.dry:
+        require_root()
+        missing = check_commands()
+        if missing:
+            print(f"vpcctl: missing required commands: {', '.join(missing)}"); sys.exit(2)
+    h(args)
+
+
+if __name__ == "__main__":  # pragma: no cover (entry point)
+    main()